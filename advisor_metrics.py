@@ -0,0 +1,121 @@
+import bisect
+import contextvars
+import cProfile
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+# Per-request cProfile of the blocking work is only honoured when this is on (it is not free).
+PROFILING_ENABLED = os.environ.get("ADVISOR_PROFILING", "0") == "1"
+PROFILE_TOP_N = 25
+
+class Histogram:
+    """Minimal Prometheus-style cumulative histogram, one series per label value."""
+
+    def __init__(self, name, help_text, label_name, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            series["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_value, series in sorted(self._series.items()):
+                label = f'{self.label_name}="{label_value}"'
+                cumulative = 0
+                for bound, count in zip(self.buckets, series["counts"]):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series["count"]}')
+                lines.append(f"{self.name}_sum{{{label}}} {series['sum']}")
+                lines.append(f"{self.name}_count{{{label}}} {series['count']}")
+        return "\n".join(lines)
+
+STAGE_DURATION = Histogram(
+    "advisor_stage_duration_seconds",
+    "Time spent in each hot-path stage (encode, vector_search, sql_fetch, snapshot_lookup, snapshot_refresh, cube_report, serialization, anomaly_compute).",
+    "stage", LATENCY_BUCKETS)
+REQUEST_DURATION = Histogram(
+    "advisor_request_duration_seconds", "End-to-end HTTP request latency by path.", "path", LATENCY_BUCKETS)
+QUERY_BATCH_SIZE = Histogram(
+    "advisor_query_batch_size", "Number of /query searches served by one encode + FAISS call.", "endpoint", BATCH_SIZE_BUCKETS)
+
+# (stage, seconds) pairs for the request being handled; feeds the Server-Timing header.
+_request_timings = contextvars.ContextVar("advisor_request_timings", default=None)
+_profile_requested = contextvars.ContextVar("advisor_profile_requested", default=False)
+
+def start_request_timings(profile=None):
+    """Starts collecting stage timings for the current request/task and returns the list.
+
+    profile=True asks for cProfile output of the request's thread-pool work; None keeps the current setting.
+    """
+    timings = []
+    _request_timings.set(timings)
+    if profile is not None:
+        _profile_requested.set(profile and PROFILING_ENABLED)
+    return timings
+
+def record_stage(stage, seconds, observe=True):
+    """Adds a stage duration to the current request's timings and (optionally) the stage histogram."""
+    if observe:
+        STAGE_DURATION.observe(stage, seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+@contextmanager
+def stage_timer(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+def server_timing_header(timings):
+    """Formats (stage, seconds) pairs as a Server-Timing header; repeated stages are summed."""
+    totals = {}
+    for stage, seconds in timings:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+    return ", ".join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in totals.items())
+
+def call_with_optional_profile(fn, *args, **kwargs):
+    """Runs fn, under cProfile if the current request asked for it (X-Profile: 1 with ADVISOR_PROFILING=1).
+
+    Used by the thread pool, so the profile covers the blocking work rather than the event loop.
+    """
+    if not _profile_requested.get():
+        return fn(*args, **kwargs)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn, *args, **kwargs)
+    finally:
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+        logger.info("Profile of %s:\n%s", getattr(fn, "__name__", fn), stream.getvalue())
+
+def render_metrics(extra_lines=()):
+    """Renders every histogram (plus caller-supplied gauge lines) in Prometheus text format."""
+    sections = [STAGE_DURATION.render(), REQUEST_DURATION.render(), QUERY_BATCH_SIZE.render()]
+    sections.extend(extra_lines)
+    return "\n".join(sections) + "\n"
@@ -0,0 +1,291 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from advisor_metrics import stage_timer
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration (override through environment variables) ---
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")  # Same data directory as rag_agent_logic
+SNAPSHOT_DIR = os.environ.get("ADVISOR_SNAPSHOT_DIR", os.path.join(DATA_DIR, "snapshots"))
+KEEP_SNAPSHOTS = 2  # Published snapshots kept on disk (the current one plus its predecessor)
+POINTER_FILE = "CURRENT"
+META_FILE = "meta.json"
+CATEGORICAL_COLUMNS = ("mall_name", "branch_name", "transaction_type", "transaction_status")
+# Stored arrays; every one is memory-mapped read-only by each process that opens the snapshot.
+ARRAY_NAMES = ("transaction_id", "timestamp_ns", "transaction_amount", "tax_amount") + CATEGORICAL_COLUMNS + (
+    "sorted_ids", "id_order", "mall_order", "mall_offsets")
+SQL_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"  # transaction_date as stored in the transactions table
+ISO_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+class AnalyticsSnapshot:
+    """Read-only, columnar, memory-mapped view of the whole transactions table.
+
+    Rows are sorted by time, so a time range is a slice. Columns: fixed-width byte-string IDs,
+    int64 epoch-nanosecond timestamps, float64 amounts, and int8/int16/int32 codes for the
+    categorical columns. Secondary indexes: the IDs in sorted order with their row positions
+    (binary-search lookups), and row positions grouped by mall (time-ordered within each mall).
+    The arrays are np.load(mmap_mode="r") files,
+    so every process that opens the same snapshot shares one copy in the page cache, and frame()
+    hands out DataFrames whose columns are views of them rather than copies. IDs are left out of
+    frame() (they would have to be decoded to str for every row); transaction_ids() decodes the
+    few rows a result actually reports.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        self.version = meta["version"]
+        self.row_count = meta["row_count"]
+        self.last_rowid = meta["last_rowid"]
+        self.change_id = meta.get("change_id")  # Table change-log position the rows were read at (None: no log)
+        self.categories = meta["categories"]
+        self.arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ARRAY_NAMES}
+        self._mall_codes = {mall: code for code, mall in enumerate(self.categories["mall_name"])}
+
+    def time_range(self, start=None, end=None):
+        """Slice of rows with start <= transaction_date < end."""
+        timestamps = self.arrays["timestamp_ns"]
+        first = np.searchsorted(timestamps, pd.Timestamp(start).value, side="left") if start is not None else 0
+        last = np.searchsorted(timestamps, pd.Timestamp(end).value, side="left") if end is not None else len(timestamps)
+        return slice(int(first), int(last))
+
+    def mall_rows(self, mall_name, start=None, end=None):
+        """Row positions for one mall (optionally within [start, end)), in time order; a view of the mall index."""
+        code = self._mall_codes.get(mall_name)
+        if code is None:
+            return np.empty(0, dtype="int64")
+        offsets = self.arrays["mall_offsets"]
+        positions = self.arrays["mall_order"][offsets[code]:offsets[code + 1]]
+        if start is None and end is None:
+            return positions
+        timestamps = self.arrays["timestamp_ns"][positions]
+        first = np.searchsorted(timestamps, pd.Timestamp(start).value) if start is not None else 0
+        last = np.searchsorted(timestamps, pd.Timestamp(end).value) if end is not None else len(positions)
+        return positions[first:last]
+
+    def positions_for_ids(self, transaction_ids):
+        """Row positions of the given IDs that are in the snapshot, plus the IDs that are not."""
+        wanted = np.asarray([str(transaction_id) for transaction_id in transaction_ids], dtype="S")
+        sorted_ids, id_order = self.arrays["sorted_ids"], self.arrays["id_order"]
+        if len(sorted_ids) == 0 or len(wanted) == 0:
+            return np.empty(0, dtype="int64"), list(transaction_ids)
+        sorted_positions = np.clip(np.searchsorted(sorted_ids, wanted), 0, len(sorted_ids) - 1)
+        found = sorted_ids[sorted_positions] == wanted
+        positions = id_order[sorted_positions]
+        missing = [transaction_id for transaction_id, hit in zip(transaction_ids, found) if not hit]
+        return np.asarray(positions[found], dtype="int64"), missing
+
+    def frame(self, rows=slice(None)):
+        """DataFrame over the selected rows (a slice gives zero-copy column views; positions gather).
+
+        The index holds the snapshot row positions and there is no transaction_id column: pass the
+        index of the rows you report to transaction_ids(). transaction_date is datetime64[ns] and
+        categorical columns are pandas Categoricals over the stored codes. The columns are read-only:
+        add or replace columns, never write into them.
+        """
+        arrays = self.arrays
+        if isinstance(rows, slice):
+            index = pd.RangeIndex(*rows.indices(self.row_count))
+        else:
+            index = pd.Index(np.asarray(rows, dtype="int64"))
+        columns = {}
+        for column in CATEGORICAL_COLUMNS[:2]:
+            columns[column] = pd.Categorical.from_codes(arrays[column][rows], categories=self.categories[column], validate=False)
+        columns["transaction_date"] = arrays["timestamp_ns"][rows].view("datetime64[ns]")
+        columns["tax_amount"] = arrays["tax_amount"][rows]
+        columns["transaction_amount"] = arrays["transaction_amount"][rows]
+        for column in CATEGORICAL_COLUMNS[2:]:
+            columns[column] = pd.Categorical.from_codes(arrays[column][rows], categories=self.categories[column], validate=False)
+        return pd.DataFrame(columns, index=index, copy=False)
+
+    def transaction_ids(self, positions):
+        """IDs (as str) of the rows at the given snapshot positions, e.g. the index of a frame() result."""
+        return self.arrays["transaction_id"][np.asarray(positions, dtype="int64")].astype(str)
+
+    def details_for_ids(self, transaction_ids):
+        """Rows for the IDs in the transactions-table shape (text dates, plain strings).
+
+        Returns (details_df, missing_ids); missing IDs (e.g. rows newer than the snapshot) are left to the caller.
+        """
+        positions, missing = self.positions_for_ids(transaction_ids)
+        details = self.frame(positions).reset_index(drop=True)
+        details.insert(0, "transaction_id", self.transaction_ids(positions))
+        dates = details["transaction_date"]
+        details = details.astype({column: str for column in CATEGORICAL_COLUMNS})
+        details["transaction_date"] = dates.dt.strftime(SQL_DATE_FORMAT)
+        details["transaction_date_iso"] = dates.dt.strftime(ISO_DATE_FORMAT)
+        return details, missing
+
+    def memory_bytes(self):
+        return int(sum(array.nbytes for array in self.arrays.values()))
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "version": self.version,
+            "rows": self.row_count,
+            "bytes": self.memory_bytes(),
+            "bytes_per_million_rows": round(self.memory_bytes() / self.row_count * 1_000_000) if self.row_count else None,
+        }
+
+def _encode_categorical(values, categories):
+    """Codes for values against categories, appending unseen values; each distinct value is looked up once."""
+    categories = list(categories)
+    positions = {category: code for code, category in enumerate(categories)}
+    codes, uniques = pd.factorize(pd.Series(values).astype(str), use_na_sentinel=False)
+    for value in uniques:
+        if value not in positions:
+            positions[value] = len(categories)
+            categories.append(value)
+    unique_codes = np.array([positions[value] for value in uniques], dtype="int64")
+    return unique_codes[codes] if len(uniques) else np.empty(0, dtype="int64"), categories
+
+def _code_dtype(category_count):
+    """The code width pandas itself uses for this many categories, so Categorical.from_codes does not copy."""
+    for dtype in ("int8", "int16", "int32"):
+        if category_count < np.iinfo(dtype).max:
+            return dtype
+    return "int64"
+
+def _snapshot_name(version):
+    return "snapshot-" + hashlib.sha1(str(version).encode("utf-8")).hexdigest()[:16]
+
+def publish_snapshot(new_rows, version, last_rowid, base=None, root=SNAPSHOT_DIR, change_id=None):
+    """Writes a snapshot of base's rows plus new_rows (transactions-table columns) and makes it current.
+
+    The arrays go into a temporary directory that is renamed into place, then the CURRENT pointer
+    is replaced atomically, so readers see either the old snapshot or the complete new one.
+    A snapshot for the same data version that another process already published is reused.
+    """
+    os.makedirs(root, exist_ok=True)
+    name = _snapshot_name(version)
+    final_path = os.path.join(root, name)
+    if not os.path.isdir(final_path):
+        dates = pd.to_datetime(new_rows["transaction_date"]).to_numpy().astype("datetime64[ns]").astype("int64")
+        columns = {
+            "transaction_id": new_rows["transaction_id"].astype(str).to_numpy(dtype="S"),
+            "timestamp_ns": dates,
+            "transaction_amount": pd.to_numeric(new_rows["transaction_amount"]).to_numpy(dtype="float64"),
+            "tax_amount": pd.to_numeric(new_rows["tax_amount"]).to_numpy(dtype="float64"),
+        }
+        categories = {}
+        for column in CATEGORICAL_COLUMNS:
+            codes, categories[column] = _encode_categorical(new_rows[column], base.categories[column] if base else [])
+            columns[column] = codes
+        if base is not None:
+            for column, values in columns.items():
+                columns[column] = np.concatenate([np.asarray(base.arrays[column]), values])
+        for column in CATEGORICAL_COLUMNS:
+            columns[column] = columns[column].astype(_code_dtype(len(categories[column])))
+
+        if len(columns["timestamp_ns"]) > 1 and (np.diff(columns["timestamp_ns"]) < 0).any():
+            order = np.argsort(columns["timestamp_ns"], kind="stable")
+            columns = {column: values[order] for column, values in columns.items()}
+        position_dtype = "int32" if len(columns["timestamp_ns"]) < 2 ** 31 else "int64"
+        columns["id_order"] = np.argsort(columns["transaction_id"], kind="stable").astype(position_dtype)
+        columns["sorted_ids"] = columns["transaction_id"][columns["id_order"]]
+        # Stable sort by mall keeps each mall's rows in time order.
+        columns["mall_order"] = np.argsort(columns["mall_name"], kind="stable").astype(position_dtype)
+        columns["mall_offsets"] = np.concatenate([[0], np.cumsum(np.bincount(columns["mall_name"], minlength=len(categories["mall_name"])))]).astype("int64")
+
+        tmp_path = os.path.join(root, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(tmp_path)
+        for column, values in columns.items():
+            np.save(os.path.join(tmp_path, f"{column}.npy"), values)
+        with open(os.path.join(tmp_path, META_FILE), "w") as f:
+            json.dump({"version": version, "row_count": int(len(columns["transaction_id"])), "last_rowid": last_rowid,
+                       "change_id": change_id, "categories": categories, "created": time.time()}, f)
+        try:
+            os.rename(tmp_path, final_path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)  # Another process published the same version first
+    pointer_tmp = os.path.join(root, f"{POINTER_FILE}.{uuid.uuid4().hex}")
+    with open(pointer_tmp, "w") as f:
+        f.write(name)
+    os.replace(pointer_tmp, os.path.join(root, POINTER_FILE))
+    _prune(root, keep=name)
+    return current_snapshot(root)
+
+def _prune(root, keep):
+    """Deletes all but the newest KEEP_SNAPSHOTS snapshots. Processes still mapping a deleted one keep reading it."""
+    snapshots = sorted((entry for entry in os.scandir(root) if entry.is_dir() and entry.name.startswith("snapshot-")),
+                       key=lambda entry: entry.stat().st_mtime, reverse=True)
+    kept = 1
+    for entry in snapshots:
+        if entry.name == keep:
+            continue
+        if kept < KEEP_SNAPSHOTS:
+            kept += 1
+            continue
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+_current = None
+_current_lock = threading.Lock()
+
+def current_snapshot(root=SNAPSHOT_DIR):
+    """The published snapshot for this process (remapped when the CURRENT pointer moves), or None.
+
+    Callers take the returned object once per request; a concurrent refresh swaps the module-level
+    reference without affecting snapshots already handed out.
+    """
+    global _current
+    try:
+        with open(os.path.join(root, POINTER_FILE)) as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+    snapshot = _current
+    if snapshot is not None and snapshot.name == name and os.path.dirname(snapshot.path) == root:
+        return snapshot
+    with _current_lock:
+        if _current is None or _current.name != name or os.path.dirname(_current.path) != root:
+            try:
+                _current = AnalyticsSnapshot(os.path.join(root, name))
+            except (FileNotFoundError, ValueError) as e:
+                logger.warning("Could not open analytics snapshot %s (%s); keeping the previous one.", name, e)
+        return _current
+
+def refresh_snapshot(load_transactions_since, version, get_table_change_id=None, root=SNAPSHOT_DIR):
+    """Brings the published snapshot up to `version`, reading only rows added since the current one.
+
+    load_transactions_since and get_table_change_id are the advisor_logic loaders (rows, max_rowid,
+    table_row_count, error and change_id, error). Like the cube, the snapshot is rebuilt from scratch
+    when existing rows changed: the change log moved (rows updated or deleted in place, table
+    replaced), the row counts no longer add up, or, without a change log, nothing was appended.
+    Returns (snapshot, error_message).
+    """
+    base = current_snapshot(root)
+    if base is not None and base.version == version:
+        return base, None
+    if os.path.isdir(os.path.join(root, _snapshot_name(version))):
+        return publish_snapshot(None, version, 0, root=root), None  # Already built by another worker
+    with stage_timer("snapshot_refresh"):
+        # Read before the rows, so a change made while they load is picked up by the next refresh.
+        change_id, change_error = get_table_change_id() if get_table_change_id else (None, None)
+        if change_error:
+            return base, change_error
+        new_rows, max_rowid, table_row_count, load_error = load_transactions_since(base.last_rowid if base else 0)
+        if load_error:
+            return base, load_error
+        rows_changed = base is not None and (change_id != base.change_id if change_id is not None else new_rows.empty)
+        if base is None or base.row_count + len(new_rows) != table_row_count or rows_changed:
+            base = None
+            new_rows, max_rowid, table_row_count, load_error = load_transactions_since(0)
+            if load_error:
+                return None, load_error
+        snapshot = publish_snapshot(new_rows, version, max_rowid, base=base, root=root, change_id=change_id)
+    logger.info("Analytics snapshot %s: %d rows, %.1f MB (%.1f MB per million rows).", snapshot.name, snapshot.row_count,
+                snapshot.memory_bytes() / 1e6, (snapshot.stats()["bytes_per_million_rows"] or 0) / 1e6)
+    return snapshot, None
@@ -0,0 +1,122 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from advisor_metrics import call_with_optional_profile
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration (override through environment variables) ---
+# Thread pool: sentence_model.encode, FAISS search and sqlite3 all release the GIL for most of their work.
+# Process pool: pandas-heavy anomaly workflows, which mostly hold the GIL.
+THREAD_POOL_SIZE = int(os.environ.get("ADVISOR_THREAD_POOL_SIZE", "4"))
+PROCESS_POOL_SIZE = int(os.environ.get("ADVISOR_PROCESS_POOL_SIZE", "2"))
+# How many jobs may wait behind the running ones before new requests are rejected with 503.
+THREAD_QUEUE_DEPTH = int(os.environ.get("ADVISOR_THREAD_QUEUE_DEPTH", "16"))
+PROCESS_QUEUE_DEPTH = int(os.environ.get("ADVISOR_PROCESS_QUEUE_DEPTH", "4"))
+
+class PoolSaturatedError(Exception):
+    """Raised when a WorkPool already has its maximum number of jobs in flight."""
+
+class PoolBrokenError(PoolSaturatedError):
+    """Raised when a process pool broke again right after being recreated; callers answer 503 as for saturation."""
+
+class WorkPool:
+    """Runs blocking callables on an executor with a hard cap on in-flight jobs.
+
+    The cap is the pool size plus the allowed queue depth. Once it is reached, submit()
+    fails immediately instead of queueing, so callers can answer with a fast 503.
+    With an executor_factory, a process pool left broken by a dead worker (OOM, a crash in
+    native code, a failed spawn import) is replaced and the job retried once.
+    """
+
+    def __init__(self, name, executor, max_workers, queue_depth, executor_factory=None):
+        self.name = name
+        self.executor = executor
+        self.executor_factory = executor_factory
+        self.max_workers = max_workers
+        self.max_in_flight = max_workers + queue_depth
+        self.in_flight = 0
+        self.rejected = 0
+        self.restarts = 0
+        self._lock = threading.Lock()  # in_flight is released from executor threads
+        self._executor_lock = threading.Lock()
+        # Thread jobs run inside a copy of the caller's context so stage timers and the profiling
+        # flag follow the request; process jobs cannot carry a context across the pickle boundary.
+        self.propagate_context = isinstance(executor, ThreadPoolExecutor)
+
+    async def submit(self, fn, *args, **kwargs):
+        if self.propagate_context:
+            call = functools.partial(contextvars.copy_context().run, call_with_optional_profile, fn, *args, **kwargs)
+        else:
+            call = functools.partial(fn, *args, **kwargs)
+        executor = self.executor
+        try:
+            return await self._run(executor, call)
+        except BrokenProcessPool as e:
+            if self.executor_factory is None:
+                raise
+            self._replace_broken(executor, e)
+        executor = self.executor
+        try:
+            return await self._run(executor, call)
+        except BrokenProcessPool as e:
+            self._replace_broken(executor, e)
+            raise PoolBrokenError(f"{self.name} pool workers died twice in a row ({e})") from e
+
+    def _replace_broken(self, executor, exc):
+        """Swaps in a fresh executor, once per broken one however many jobs saw it break."""
+        with self._executor_lock:
+            if self.executor is not executor:
+                return
+            logger.error("%s pool is broken (%s); starting a new executor.", self.name, exc)
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = self.executor_factory()
+            self.restarts += 1
+
+    async def _run(self, executor, call):
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                self.rejected += 1
+                raise PoolSaturatedError(f"{self.name} pool is saturated ({self.in_flight}/{self.max_in_flight} jobs in flight)")
+            self.in_flight += 1
+        try:
+            future = executor.submit(call)
+        except BaseException:
+            self._release()
+            raise
+        # The slot is freed when the job finishes, not when its caller stops waiting: a request
+        # cancelled by a client disconnect leaves its job running, and it still counts as load.
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def _release(self, future=None):
+        with self._lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        return {
+            "workers": self.max_workers,
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "rejected": self.rejected,
+            "restarts": self.restarts,
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+def create_thread_pool(size=THREAD_POOL_SIZE, queue_depth=THREAD_QUEUE_DEPTH):
+    executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="advisor-io")
+    return WorkPool("thread", executor, size, queue_depth)
+
+def create_process_pool(size=PROCESS_POOL_SIZE, queue_depth=PROCESS_QUEUE_DEPTH):
+    # "spawn" so worker processes never inherit the event loop's threads or locks mid-fork.
+    executor_factory = functools.partial(ProcessPoolExecutor, max_workers=size, mp_context=multiprocessing.get_context("spawn"))
+    return WorkPool("process", executor_factory(), size, queue_depth, executor_factory=executor_factory)
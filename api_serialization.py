@@ -0,0 +1,97 @@
+import hashlib
+import json
+
+import numpy as np
+import pandas as pd
+from fastapi.responses import Response
+
+from advisor_metrics import stage_timer
+
+# orjson serializes numpy arrays natively and is several times faster than the stdlib encoder.
+# It is optional: without it responses fall back to json.dumps with a numpy-aware default.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# --- Configuration ---
+ISO_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+RESPONSE_FORMATS = ("records", "columns")
+GZIP_MIN_BYTES = 1024  # Responses smaller than this are sent uncompressed
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (pd.Timestamp, np.datetime64)):
+        return pd.Timestamp(value).strftime(ISO_DATETIME_FORMAT)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps(content):
+    """Serializes content (which may contain numpy arrays and scalars) to JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(content, default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_json_default, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(Response):
+    """JSONResponse replacement that serializes numpy/pandas values directly (see dumps)."""
+    media_type = "application/json"
+
+    def render(self, content):
+        with stage_timer("serialization"):
+            return dumps(content)
+
+def frame_columns(df):
+    """Converts a DataFrame to {column: values} one column at a time.
+
+    Numeric columns stay numpy arrays (serialized natively by orjson), datetimes become ISO
+    strings in one vectorized strftime, everything else becomes a plain list.
+    """
+    columns = {}
+    for name in df.columns:
+        column = df[name]
+        if pd.api.types.is_datetime64_any_dtype(column):
+            iso = column.dt.strftime(ISO_DATETIME_FORMAT)
+            columns[name] = iso.where(column.notna(), None).tolist()
+        elif pd.api.types.is_numeric_dtype(column) and not pd.api.types.is_bool_dtype(column):
+            columns[name] = column.to_numpy()
+        else:
+            columns[name] = column.astype(object).where(column.notna(), None).tolist()
+    return columns
+
+def frame_to_payload(df, response_format="records"):
+    """Returns df as a list of row dicts ("records") or a column-oriented dict ("columns").
+
+    The column-oriented shape repeats no keys and keeps numeric columns as arrays, so it is
+    both smaller on the wire and cheaper to build.
+    """
+    columns = frame_columns(df)
+    if response_format == "columns":
+        return columns
+    names = list(columns)
+    values = [col.tolist() if isinstance(col, np.ndarray) else col for col in columns.values()]
+    return [dict(zip(names, row)) for row in zip(*values)]
+
+def make_etag(*parts):
+    """Builds a weak ETag from the data/index version plus whatever identifies the request.
+
+    Weak because GZipMiddleware sends the same content gzip-encoded or as-is under this one tag,
+    and a strong validator would promise byte-identical bodies.
+    """
+    digest = hashlib.sha1("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+    return f'W/"{digest[:32]}"'
+
+def _opaque_tag(tag):
+    return tag[2:] if tag.startswith("W/") else tag
+
+def etag_matches(request, etag):
+    """If-None-Match uses the weak comparison: tags match when their opaque parts do, W/ or not."""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or _opaque_tag(etag) in {_opaque_tag(tag) for tag in candidates}
+
+def not_modified(etag):
+    return Response(status_code=304, headers={"ETag": etag})
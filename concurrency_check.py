@@ -0,0 +1,195 @@
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from api_concurrency import PoolSaturatedError, create_thread_pool
+
+# --- Configuration ---
+SLOW_JOB_SECONDS = 0.2   # Stand-in for a slow encode + FAISS search + sqlite fetch
+SLOW_REQUESTS = 8
+FAST_REQUESTS = 200      # Cheap requests (e.g. health checks) issued while the slow ones are running
+FAST_REQUEST_INTERVAL = 0.005
+# HTTP check: the real API on a load_harness fixture, with pools small enough to saturate on purpose.
+HTTP_FIXTURE_ROWS = 20_000
+HTTP_ENCODE_MS = 200     # Simulated model cost per encode() call
+HTTP_SERVER_ENV = {
+    "ADVISOR_THREAD_POOL_SIZE": "1",
+    "ADVISOR_THREAD_QUEUE_DEPTH": "1",
+    "ADVISOR_PROCESS_POOL_SIZE": "1",
+    "ADVISOR_PROCESS_QUEUE_DEPTH": "0",
+    "ADVISOR_BATCH_MAX_SIZE": "1",  # One pool job per /query, so the cap is reached by request count
+    "ADVISOR_HARNESS_ENCODE_MS": str(HTTP_ENCODE_MS),
+}
+HTTP_BURST = 8           # Concurrent requests per endpoint in the burst
+# Pass/fail bounds. A blocked event loop delays cheap requests by whole slow jobs, far above these.
+FAST_P99_LIMIT_SECONDS = 0.05          # Offloaded in-process scenarios, fast-request p99
+HTTP_STATS_P99_LIMIT_SECONDS = 0.15    # /stats p99 during the HTTP burst (below one HTTP_ENCODE_MS encode)
+IN_FLIGHT_DRAIN_SECONDS = 10           # Abandoned jobs must finish and free their slots within this
+
+def blocking_work(seconds):
+    """Simulates a blocking model/DB call that does not yield to the event loop."""
+    time.sleep(seconds)
+    return seconds
+
+async def slow_request(pool):
+    if pool is None:
+        return blocking_work(SLOW_JOB_SECONDS)  # Old behaviour: called directly inside the async handler
+    try:
+        return await pool.submit(blocking_work, SLOW_JOB_SECONDS)
+    except PoolSaturatedError:
+        return None  # Would be a fast 503 in the API
+
+async def fast_request(intended_start):
+    """Open-loop client: latency is measured from when the request was due, so a blocked loop shows up in the tail."""
+    await asyncio.sleep(max(0.0, intended_start - time.perf_counter()))
+    await asyncio.sleep(0)
+    return time.perf_counter() - intended_start
+
+async def issue_fast_requests():
+    t0 = time.perf_counter()
+    tasks = [asyncio.create_task(fast_request(t0 + i * FAST_REQUEST_INTERVAL)) for i in range(FAST_REQUESTS)]
+    return await asyncio.gather(*tasks)
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+async def run_scenario(pool):
+    fast_task = asyncio.create_task(issue_fast_requests())
+    slow_results = await asyncio.gather(*(slow_request(pool) for _ in range(SLOW_REQUESTS)))
+    latencies = await fast_task
+    rejected = sum(1 for r in slow_results if r is None)
+    return latencies, rejected
+
+def report(label, latencies, rejected):
+    print(f"{label}: fast-request p50={percentile(latencies, 50) * 1000:.1f}ms "
+          f"p95={percentile(latencies, 95) * 1000:.1f}ms p99={percentile(latencies, 99) * 1000:.1f}ms "
+          f"max={max(latencies) * 1000:.1f}ms mean={statistics.mean(latencies) * 1000:.1f}ms "
+          f"(slow requests rejected with 503: {rejected})")
+
+def check(failures, passed, message):
+    """Records a failed expectation; the script exits non-zero if any were recorded."""
+    print(f"  {'ok  ' if passed else 'FAIL'} {message}")
+    if not passed:
+        failures.append(message)
+
+async def http_burst(base_url, failures):
+    """Bursts /query and /run_anomaly_detection past the pool caps while timing /stats on the same server.
+
+    Also abandons a few /query calls mid-flight (client timeout) and reads the pool's in-flight
+    count straight afterwards: the jobs are still running, so they must still be counted, and
+    must be released once they finish.
+    """
+    import httpx
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+        await client.post("/run_anomaly_detection")  # Spawns the process pool before timing anything
+
+        async def probe_stats(stop):
+            latencies = []
+            while not stop.is_set():
+                started = time.perf_counter()
+                await client.get("/stats")
+                latencies.append(time.perf_counter() - started)
+                await asyncio.sleep(FAST_REQUEST_INTERVAL)
+            return latencies
+
+        stop = asyncio.Event()
+        probe = asyncio.create_task(probe_stats(stop))
+        burst = [client.post("/query", data={"query_text": f"failed sales at Z Mall {i}"}) for i in range(HTTP_BURST)]
+        burst += [client.post("/run_anomaly_detection") for _ in range(HTTP_BURST)]
+        responses = await asyncio.gather(*burst)
+        stop.set()
+        stats_latencies = await probe
+
+        abandoned = 0
+        for i in range(2):
+            try:
+                await client.post("/query", data={"query_text": f"refunds at C Mall Amman {i}"}, timeout=HTTP_ENCODE_MS / 4000)
+            except httpx.TimeoutException:
+                abandoned += 1
+        in_flight_after_abandon = (await client.get("/stats")).json()["thread_pool"]["in_flight"]
+        deadline = time.monotonic() + IN_FLIGHT_DRAIN_SECONDS
+        while True:
+            pool_stats = (await client.get("/stats")).json()
+            in_flight_drained = pool_stats["thread_pool"]["in_flight"] + pool_stats["process_pool"]["in_flight"]
+            if in_flight_drained == 0 or time.monotonic() > deadline:
+                break
+            await asyncio.sleep(0.1)
+
+    statuses = {}
+    for response in responses:
+        key = (response.request.url.path, response.status_code)
+        statuses[key] = statuses.get(key, 0) + 1
+    retry_after = {response.headers.get("retry-after") for response in responses if response.status_code == 503}
+    print(f"HTTP burst ({HTTP_BURST} x /query, {HTTP_BURST} x /run_anomaly_detection): "
+          + ", ".join(f"{path} {status}: {count}" for (path, status), count in sorted(statuses.items())))
+    print(f"  503 responses carry Retry-After: {sorted(retry_after) or 'n/a'}")
+    print(f"  /stats during the burst: p50={percentile(stats_latencies, 50) * 1000:.1f}ms "
+          f"p99={percentile(stats_latencies, 99) * 1000:.1f}ms max={max(stats_latencies) * 1000:.1f}ms ({len(stats_latencies)} calls)")
+    print(f"  {abandoned} /query calls abandoned by the client; thread-pool jobs still in flight right after: {in_flight_after_abandon}")
+    rejected = [response for response in responses if response.status_code == 503]
+    check(failures, bool(rejected), "the burst past the pool caps is shed with 503")
+    check(failures, all(response.headers.get("retry-after") == "1" for response in rejected), "every 503 carries Retry-After: 1")
+    check(failures, all(response.status_code in (200, 503) for response in responses), "no burst request fails with another status")
+    check(failures, percentile(stats_latencies, 99) < HTTP_STATS_P99_LIMIT_SECONDS,
+          f"/stats p99 during the burst is below {HTTP_STATS_P99_LIMIT_SECONDS * 1000:.0f}ms")
+    check(failures, in_flight_after_abandon >= abandoned, "abandoned /query jobs still count as in flight")
+    check(failures, in_flight_drained == 0, f"in-flight jobs return to 0 within {IN_FLIGHT_DRAIN_SECONDS}s")
+
+def run_http_check(failures, workdir=None):
+    import load_harness
+
+    workdir = workdir or tempfile.mkdtemp(prefix="advisor-concurrency-")
+    shim_dir, data_dir = os.path.join(workdir, "shim"), os.path.join(workdir, "data")
+    load_harness.write_shim_modules(shim_dir)
+    sys.path.insert(0, shim_dir)
+    if not os.path.exists(os.path.join(data_dir, "transaction_index.faiss")):
+        load_harness.build_fixture(data_dir, HTTP_FIXTURE_ROWS)
+    port = load_harness.free_port()
+    server = load_harness.start_server(shim_dir, data_dir, port, extra_env=HTTP_SERVER_ENV)
+    try:
+        asyncio.run(http_burst(f"http://127.0.0.1:{port}", failures))
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+async def main(failures):
+    latencies, rejected = await run_scenario(None)
+    report("Blocking on the event loop", latencies, rejected)
+    # Confirms the bound can fail at all: blocking the loop must push the tail past it.
+    check(failures, percentile(latencies, 99) >= FAST_P99_LIMIT_SECONDS, "blocking the event loop is visible in the fast-request p99")
+
+    pool = create_thread_pool(size=4, queue_depth=16)
+    latencies, rejected = await run_scenario(pool)
+    report("Offloaded to thread pool   ", latencies, rejected)
+    check(failures, percentile(latencies, 99) < FAST_P99_LIMIT_SECONDS, f"offloaded fast-request p99 is below {FAST_P99_LIMIT_SECONDS * 1000:.0f}ms")
+    check(failures, rejected == 0, "a pool with room for every job rejects none")
+    check(failures, pool.in_flight == 0, "in-flight jobs return to 0")
+    pool.shutdown()
+
+    small_pool = create_thread_pool(size=2, queue_depth=2)
+    latencies, rejected = await run_scenario(small_pool)
+    report("Offloaded, 2 workers + 2 queued", latencies, rejected)
+    check(failures, percentile(latencies, 99) < FAST_P99_LIMIT_SECONDS, f"saturated-pool fast-request p99 is below {FAST_P99_LIMIT_SECONDS * 1000:.0f}ms")
+    check(failures, rejected == SLOW_REQUESTS - 4, "jobs beyond 2 workers + 2 queued are rejected")
+    check(failures, small_pool.in_flight == 0, "in-flight jobs return to 0")
+    small_pool.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Event-loop responsiveness and 503 load shedding, in-process and over HTTP.")
+    parser.add_argument("--skip-http", action="store_true", help="Only run the in-process pool comparison")
+    parser.add_argument("--workdir", help="Fixture directory for the HTTP check (default: a new temp dir)")
+    args = parser.parse_args()
+    failures = []
+    asyncio.run(main(failures))
+    if not args.skip_http:
+        run_http_check(failures, args.workdir)
+    if failures:
+        print(f"{len(failures)} concurrency check(s) failed.")
+        sys.exit(1)
+    print("All concurrency checks passed.")
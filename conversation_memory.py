@@ -0,0 +1,131 @@
+import os
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+# --- Configuration (override through environment variables) ---
+MAX_SESSIONS = int(os.environ.get("ADVISOR_MAX_SESSIONS", "1000"))
+SESSION_TTL_SECONDS = int(os.environ.get("ADVISOR_SESSION_TTL_SECONDS", "1800"))
+MAX_TURNS_PER_SESSION = 10
+# How many ranked search hits a lookup turn remembers for follow-ups to narrow down.
+CANDIDATE_POOL_SIZE = int(os.environ.get("ADVISOR_CANDIDATE_POOL_SIZE", "100"))
+
+# Openers that refer back to the previous answer instead of asking something new.
+FOLLOW_UP_CUES = re.compile(
+    r"^\s*(only|just|and|but|now|what about|how about|same|those|these|them|of (those|these|them)|"
+    r"among (those|these|them)|filter|narrow|exclude|excluding|without|also)\b"
+    r"|\b(of|among|from) (those|these|them)\b|\bthe (failed|completed|refund|sale)s? ones\b|\bones\b")
+
+def is_follow_up(query_text):
+    return bool(FOLLOW_UP_CUES.search(query_text.lower()))
+
+class UnknownSessionError(KeyError):
+    """Raised by SessionStore.add_turn for a session that expired or was evicted (it is not recreated)."""
+
+class SessionStore:
+    """Bounded, expiring, in-process store of conversation turns keyed by server-issued session ids.
+
+    Least recently used sessions are evicted beyond max_sessions; sessions idle for longer than
+    ttl_seconds are dropped on access. Each turn is a dict (query, intent, filters, time range and,
+    for lookups, the ranked candidate IDs/scores that a follow-up can narrow). Ids embed the pid of
+    the process that issued them, so another pre-forked worker can tell "not mine" from "expired".
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, ttl_seconds=SESSION_TTL_SECONDS, max_turns=MAX_TURNS_PER_SESSION):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_turns = max_turns
+        self._sessions = OrderedDict()  # session_id -> {"touched": monotonic seconds, "turns": [...], "sequence": int}
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session["touched"] <= self.ttl_seconds:
+                break
+            del self._sessions[session_id]
+
+    def _evict(self, now):
+        self._expire(now)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def create_session(self):
+        """Issues a new, empty session and returns its id."""
+        session_id = f"{os.getpid():x}-{secrets.token_urlsafe(16)}"
+        with self._lock:
+            now = time.monotonic()
+            self._sessions[session_id] = {"touched": now, "turns": [], "sequence": 0}
+            self._evict(now)
+        return session_id
+
+    def __contains__(self, session_id):
+        with self._lock:
+            self._expire(time.monotonic())
+            return session_id in self._sessions
+
+    @staticmethod
+    def issued_by_this_process(session_id):
+        return session_id.split("-", 1)[0] == f"{os.getpid():x}"
+
+    def last_turn(self, session_id):
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            session = self._sessions.get(session_id)
+            if session is None or not session["turns"]:
+                return None
+            return session["turns"][-1]
+
+    def sequence(self, session_id):
+        """How many turns the session has ever recorded; unlike len(turns) it is not capped by max_turns."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return session["sequence"] if session is not None else 0
+
+    def add_turn(self, session_id, turn):
+        """Appends a turn to an existing session; raises UnknownSessionError if it expired or was evicted meanwhile."""
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            session = self._sessions.pop(session_id, None)
+            if session is None:
+                raise UnknownSessionError(session_id)
+            session["touched"] = now
+            session["turns"] = (session["turns"] + [turn])[-self.max_turns:]
+            session["sequence"] += 1
+            self._sessions[session_id] = session  # Re-inserted at the end: most recently used
+            self._evict(now)
+
+    def __len__(self):
+        return len(self._sessions)
+
+def merge_context(previous_turn, new_filters, start, end):
+    """Previous turn's filters/time range overridden by whatever the follow-up mentions."""
+    filters = dict(previous_turn.get("filters") or {})
+    if "mall_name" in new_filters or "branch_name" in new_filters:
+        # A new place replaces the old one ("what about Y Mall" after "... at Z Mall Gardens").
+        filters.pop("mall_name", None)
+        filters.pop("branch_name", None)
+    filters.update(new_filters)
+    if start is None and end is None:
+        start, end = previous_turn.get("start"), previous_turn.get("end")
+    return filters, start, end
+
+def filter_candidates(details_df, filters, start=None, end=None):
+    """Narrows candidate transaction details to the follow-up's filters and [start, end) range."""
+    mask = pd.Series(True, index=details_df.index)
+    for dimension, values in filters.items():
+        if dimension in details_df.columns:
+            mask &= details_df[dimension].isin(values)
+    if (start is not None or end is not None) and "transaction_date" in details_df.columns:
+        dates = pd.to_datetime(details_df["transaction_date"])
+        if start is not None:
+            mask &= dates >= start
+        if end is not None:
+            mask &= dates < end
+    return details_df[mask]
@@ -5,12 +5,18 @@ from sentence_transformers import SentenceTransformer
 import numpy as np
 import os
 
+from structured_encoder import StructuredTransactionEncoder, save_encoder_meta
+
 # --- Configuration ---
 CLEANED_CSV_PATH = "cleaned_jordan_transactions.csv"
 DB_PATH = "transactions.db"
 TRANSACTIONS_TABLE_NAME = "transactions"
+# Rows changed in place are logged here by triggers; appends need no log, readers track them by rowid.
+CHANGE_LOG_TABLE_NAME = "transaction_changes"
 FAISS_INDEX_PATH = "transaction_index.faiss"
 EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2' # A good default, relatively small and fast
+# "text": sentence embeddings of a prose rendering of each row; "structured": structured_encoder.py feature vectors
+INDEX_ENCODER = os.environ.get("ADVISOR_INDEX_ENCODER", "text")
 
 def store_data_in_sql(df, db_path, table_name):
     """Stores the DataFrame into an SQLite database."""
@@ -29,6 +35,8 @@ def store_data_in_sql(df, db_path, table_name):
             df_for_sql['transaction_date'] = df_for_sql['transaction_date'].astype(str)
             
         df_for_sql.to_sql(table_name, conn, if_exists='replace', index=False)
+        install_change_log(conn, table_name)
+        conn.commit()
         conn.close()
         print(f"Data successfully stored in SQLite table 	'{table_name}\' at {db_path}")
         # Verify by reading back a few rows
@@ -42,6 +50,22 @@ def store_data_in_sql(df, db_path, table_name):
         print(f"Error storing data in SQL: {e}")
         return False
 
+def install_change_log(conn, table_name, change_log_table=CHANGE_LOG_TABLE_NAME):
+    """Logs every UPDATE/DELETE on table_name (and this replacement of it) into change_log_table.
+
+    Incremental readers (the API's aggregate cube and analytics snapshot) only fetch rows beyond
+    the last rowid they saw; a new change_id tells them existing rows changed and they must rebuild.
+    """
+    conn.executescript(f"""
+        CREATE TABLE IF NOT EXISTS {change_log_table} (
+            change_id INTEGER PRIMARY KEY AUTOINCREMENT, changed_rowid INTEGER, operation TEXT NOT NULL);
+        CREATE TRIGGER IF NOT EXISTS {table_name}_log_update AFTER UPDATE ON {table_name}
+        BEGIN INSERT INTO {change_log_table} (changed_rowid, operation) VALUES (old.rowid, 'update'); END;
+        CREATE TRIGGER IF NOT EXISTS {table_name}_log_delete AFTER DELETE ON {table_name}
+        BEGIN INSERT INTO {change_log_table} (changed_rowid, operation) VALUES (old.rowid, 'delete'); END;
+    """)
+    conn.execute(f"INSERT INTO {change_log_table} (changed_rowid, operation) VALUES (NULL, 'replace')")
+
 def prepare_data_for_vectorization(df):
     """Prepares a textual representation for each transaction for embedding."""
     print("\n--- Task 1.4: Preparing data for vectorization ---")
@@ -71,9 +95,28 @@ def generate_embeddings_and_store_faiss(df, model_name, index_path):
         print(f"Generating embeddings for {len(texts_to_embed)} texts...")
         embeddings = model.encode(texts_to_embed, show_progress_bar=True)
         
+        print(f"Embeddings generated. Shape: {embeddings.shape}, Dimension: {embeddings.shape[1]}")
+        return store_vectors_in_faiss(embeddings, df, index_path, {"encoder": "text", "model": model_name})
+    except Exception as e:
+        print(f"Error generating/storing embeddings: {e}")
+        return False
+
+def generate_structured_vectors_and_store_faiss(df, index_path):
+    """Encodes transactions with StructuredTransactionEncoder (no text, no model) and stores them in FAISS."""
+    print(f"\n--- Task 1.5: Encoding structured features and storing in FAISS ({index_path}) ---")
+    try:
+        encoder = StructuredTransactionEncoder()
+        vectors = encoder.fit_transform(df)
+        print(f"Structured vectors generated. Shape: {vectors.shape}")
+        return store_vectors_in_faiss(vectors, df, index_path, encoder.to_dict())
+    except Exception as e:
+        print(f"Error generating/storing structured vectors: {e}")
+        return False
+
+def store_vectors_in_faiss(embeddings, df, index_path, encoder_meta):
+    """Builds and saves the FAISS index, its transaction ID maps and the .encoder.json sidecar."""
+    try:
         embedding_dim = embeddings.shape[1]
-        print(f"Embeddings generated. Shape: {embeddings.shape}, Dimension: {embedding_dim}")
-        
         # Build FAISS index
         index = faiss.IndexFlatL2(embedding_dim)  # Using L2 distance
         # For larger datasets, IndexIVFFlat might be better but requires training.
@@ -93,10 +136,16 @@ def generate_embeddings_and_store_faiss(df, model_name, index_path):
         # A more robust way is to save df[['transaction_id']] or df.index to a file.
         df[['transaction_id']].to_csv(index_path + ".meta.csv", index_label="faiss_index")
         print(f"FAISS index metadata (transaction_ids) saved to {index_path + '.meta.csv'}")
+        # Memory-mappable copy of the same IDs, shared by pre-forked API workers
+        np.save(index_path + ".ids.npy", df['transaction_id'].to_numpy(dtype="S"))
+        print(f"FAISS index ID map saved to {index_path + '.ids.npy'}")
+        # Which encoder built the index, so readers encode queries/rows the same way
+        save_encoder_meta(index_path + ".encoder.json", encoder_meta)
+        print(f"FAISS index encoder ({encoder_meta['encoder']}) recorded in {index_path + '.encoder.json'}")
 
         return True
     except Exception as e:
-        print(f"Error generating/storing embeddings: {e}")
+        print(f"Error storing vectors in FAISS: {e}")
         return False
 
 if __name__ == "__main__":
@@ -111,11 +160,15 @@ if __name__ == "__main__":
             sql_success = store_data_in_sql(cleaned_df, DB_PATH, TRANSACTIONS_TABLE_NAME)
             
             if sql_success:
-                # Task 1.4: Prepare for vectorization
-                df_for_embedding = prepare_data_for_vectorization(cleaned_df.copy()) # Use a copy
-                
-                # Task 1.5: Generate embeddings and store in FAISS
-                faiss_success = generate_embeddings_and_store_faiss(df_for_embedding, EMBEDDING_MODEL_NAME, FAISS_INDEX_PATH)
+                if INDEX_ENCODER == "structured":
+                    # Task 1.4/1.5: Encode the fields directly, no text rendering or model needed
+                    faiss_success = generate_structured_vectors_and_store_faiss(cleaned_df, FAISS_INDEX_PATH)
+                else:
+                    # Task 1.4: Prepare for vectorization
+                    df_for_embedding = prepare_data_for_vectorization(cleaned_df.copy()) # Use a copy
+
+                    # Task 1.5: Generate embeddings and store in FAISS
+                    faiss_success = generate_embeddings_and_store_faiss(df_for_embedding, EMBEDDING_MODEL_NAME, FAISS_INDEX_PATH)
                 
                 if faiss_success:
                     print("\n--- All Phase 1 Data Ingestion (Part 2) tasks completed successfully! ---")
@@ -0,0 +1,358 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+
+# --- Configuration ---
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+EMBEDDING_DIMENSION = 384  # Same width as all-MiniLM-L6-v2, so index sizes and search costs are comparable
+# Optional simulated model cost per encode() call, to keep batching effects visible without the real model.
+ENCODE_DELAY_MS = float(os.environ.get("ADVISOR_HARNESS_ENCODE_MS", "0"))
+FIXTURE_DATA_DIR_ENV = "ADVISOR_HARNESS_DATA_DIR"
+SERVER_START_TIMEOUT_SECONDS = 60
+BRANCHES = [
+    ("C Mall", "C Mall Amman"), ("C Mall", "C Mall Aqaba"), ("C Mall", "C Mall Irbid"),
+    ("Y Mall", "Y Mall Dabouq"), ("Y Mall", "Y Mall Shmeisani"), ("Y Mall", "Y Mall Tla'a Al-Ali"),
+    ("Z Mall", "Z Mall Al Bayader"), ("Z Mall", "Z Mall Al Jubeiha"), ("Z Mall", "Z Mall Gardens"),
+]
+QUERY_MIX = [
+    "failed sales at Z Mall Al Bayader recently",
+    "refund transactions at C Mall Amman",
+    "large value sales in Y Mall Dabouq",
+    "completed sales at Z Mall Gardens last week",
+    "total sales per mall last month",
+    "failure rate by branch",
+    "how many refunds this month",
+    "average amount per day last week",
+]
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.-][a-z0-9]+)*")
+
+class HashEmbedder:
+    """Deterministic, offline stand-in for SentenceTransformer (same encode() interface).
+
+    Each word is hashed (crc32, so results are identical across processes and runs) into one of
+    `dimension` buckets with a hash-derived sign; the counts are L2-normalised. Texts sharing words
+    get nearby vectors, which is all the load tests need from the real model.
+    """
+
+    def __init__(self, model_name_or_path=None, dimension=EMBEDDING_DIMENSION, **kwargs):
+        self.model_name = model_name_or_path
+        self.dimension = dimension
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, normalize_embeddings=True, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        if ENCODE_DELAY_MS:
+            time.sleep(ENCODE_DELAY_MS / 1000)
+        rows, buckets, signs = [], [], []
+        for row, text in enumerate(texts):
+            for token in TOKEN_PATTERN.findall(text.lower()):
+                digest = zlib.crc32(token.encode("utf-8"))
+                rows.append(row)
+                buckets.append(digest % self.dimension)
+                signs.append(1.0 if digest & 0x80000000 else -1.0)
+        vectors = np.zeros((len(texts), self.dimension), dtype="float32")
+        np.add.at(vectors, (np.array(rows, dtype="int64"), np.array(buckets, dtype="int64")), np.array(signs, dtype="float32"))
+        if normalize_embeddings:
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors /= np.where(norms == 0, 1, norms)
+        return vectors[0] if single else vectors
+
+def synthetic_transactions(rows, months=3, seed=0, duplicate_fraction=0.01):
+    """Random transactions in the schema of cleaned_jordan_transactions.csv, ending now.
+
+    Amounts, tax ratio, type and status mix follow the real data; duplicate_fraction of the rows are
+    repeated a few minutes later under new IDs so the near-duplicate workflow has work to do.
+    """
+    rng = np.random.default_rng(seed)
+    end = pd.Timestamp.now().floor("min")
+    span_minutes = int((end - (end - pd.DateOffset(months=months))).total_seconds() // 60)
+    branch_choice = rng.integers(0, len(BRANCHES), rows)
+    amounts = np.round(np.clip(rng.lognormal(mean=1.8, sigma=0.7, size=rows), 0.05, 500), 3)
+    df = pd.DataFrame({
+        "transaction_id": [f"SY-{i:08d}" for i in range(rows)],
+        "mall_name": np.array([mall for mall, _ in BRANCHES])[branch_choice],
+        "branch_name": np.array([branch for _, branch in BRANCHES])[branch_choice],
+        "transaction_date": end - pd.to_timedelta(rng.integers(0, span_minutes, rows), unit="min"),
+        "tax_amount": np.round(amounts * 8 / 108, 3),
+        "transaction_amount": amounts,
+        "transaction_type": np.where(rng.random(rows) < 0.006, "Refund", "Sale"),
+        "transaction_status": np.where(rng.random(rows) < 0.066, "Failed", "Completed"),
+    })
+    repeats = df.sample(frac=duplicate_fraction, random_state=seed).copy()
+    repeats["transaction_id"] = [f"SY-R{i:07d}" for i in range(len(repeats))]
+    repeats["transaction_date"] += pd.to_timedelta(rng.integers(1, 6, len(repeats)), unit="min")
+    df = pd.concat([df, repeats], ignore_index=True).sort_values("transaction_date", ignore_index=True)
+    df["transaction_date_iso"] = df["transaction_date"].dt.strftime("%Y-%m-%dT%H:%M:%S")
+    return df
+
+def write_shim_modules(shim_dir):
+    """Writes the modules the API server imports but that the offline harness replaces.
+
+    src/advisor_logic.py: the advisor_logic API, implemented by configure_fixture() + the adapter below.
+    sentence_transformers.py: HashEmbedder under the SentenceTransformer name, so no model download happens.
+    """
+    os.makedirs(os.path.join(shim_dir, "src"), exist_ok=True)
+    with open(os.path.join(shim_dir, "sentence_transformers.py"), "w") as f:
+        f.write("# Generated by load_harness.py: offline stand-in for the real package.\n"
+                "from load_harness import HashEmbedder as SentenceTransformer  # noqa: F401\n")
+    with open(os.path.join(shim_dir, "src", "advisor_logic.py"), "w") as f:
+        f.write("# Generated by load_harness.py: advisor_logic API over rag_agent_logic and the harness fixture.\n"
+                "from load_harness import configure_fixture\n"
+                "configure_fixture()\n"
+                "from load_harness import (  # noqa: E402,F401\n"
+                "    load_all_models_once, get_data_version, get_table_change_id, load_transactions_since, semantic_search_transactions_batch,\n"
+                "    find_similar_transactions, get_index_encoder, get_transaction_details_by_ids_logic, load_data_from_sql_for_anomaly,\n"
+                "    detect_failed_transaction_anomaly_logic, detect_unusual_transaction_patterns_logic,\n"
+                ")\n")
+
+def build_fixture(data_dir, rows, months=3, seed=0):
+    """Builds transactions.db and the FAISS index (+ meta/ID maps) in data_dir with the ingestion code."""
+    import data_ingestion_p2
+
+    os.makedirs(data_dir, exist_ok=True)
+    df = synthetic_transactions(rows, months=months, seed=seed)
+    db_path = os.path.join(data_dir, "transactions.db")
+    index_path = os.path.join(data_dir, "transaction_index.faiss")
+    if not data_ingestion_p2.store_data_in_sql(df, db_path, data_ingestion_p2.TRANSACTIONS_TABLE_NAME):
+        raise RuntimeError(f"Could not write the fixture database at {db_path}")
+    df_for_embedding = data_ingestion_p2.prepare_data_for_vectorization(df.copy())
+    if not data_ingestion_p2.generate_embeddings_and_store_faiss(df_for_embedding, data_ingestion_p2.EMBEDDING_MODEL_NAME, index_path):
+        raise RuntimeError(f"Could not build the fixture index at {index_path}")
+    return len(df)
+
+# --- advisor_logic adapter (imported by the generated src/advisor_logic.py inside the server) ---
+
+def configure_fixture(data_dir=None):
+    """Points rag_agent_logic at the fixture files instead of its hard-coded data directory."""
+    import rag_agent_logic
+
+    data_dir = data_dir or os.environ[FIXTURE_DATA_DIR_ENV]
+    rag_agent_logic.DB_PATH = os.path.join(data_dir, "transactions.db")
+    rag_agent_logic.FAISS_INDEX_PATH = os.path.join(data_dir, "transaction_index.faiss")
+    rag_agent_logic.FAISS_META_PATH = rag_agent_logic.FAISS_INDEX_PATH + ".meta.csv"
+    rag_agent_logic.FAISS_IDS_PATH = rag_agent_logic.FAISS_INDEX_PATH + ".ids.npy"
+    rag_agent_logic.FAISS_ENCODER_PATH = rag_agent_logic.FAISS_INDEX_PATH + ".encoder.json"
+    rag_agent_logic.SentenceTransformer = HashEmbedder
+
+def load_all_models_once():
+    import rag_agent_logic
+    return rag_agent_logic.load_retrieval_components()
+
+def get_data_version():
+    import rag_agent_logic
+    return rag_agent_logic.get_data_version()
+
+def get_table_change_id():
+    import rag_agent_logic
+    return rag_agent_logic.get_table_change_id()
+
+def load_transactions_since(last_rowid=0):
+    import rag_agent_logic
+    return rag_agent_logic.load_transactions_since(last_rowid)
+
+def semantic_search_transactions_batch(query_texts, k=5, time_ranges=None):
+    import rag_agent_logic
+    return rag_agent_logic.semantic_search_batch(query_texts, k, time_ranges)
+
+def find_similar_transactions(transaction_id, k=5):
+    import rag_agent_logic
+    return rag_agent_logic.find_similar_transactions(transaction_id, k)
+
+def get_index_encoder():
+    import rag_agent_logic
+    return rag_agent_logic.get_index_encoder()
+
+def get_transaction_details_by_ids_logic(transaction_ids, start=None, end=None):
+    import rag_agent_logic
+    return rag_agent_logic.get_transaction_details_by_ids(transaction_ids, start, end)
+
+def load_data_from_sql_for_anomaly():
+    import rag_agent_logic
+    import workflow_anomaly_detection
+    df = workflow_anomaly_detection.load_data_from_sql(rag_agent_logic.DB_PATH, rag_agent_logic.TRANSACTIONS_TABLE_NAME)
+    return (df, None) if df is not None else (None, "Could not load the fixture transactions.")
+
+def detect_failed_transaction_anomaly_logic(df, mall_name, time_window_hours=24, failure_threshold_percentage=50):
+    import workflow_anomaly_detection
+    is_anomaly, message = workflow_anomaly_detection.detect_failed_transaction_anomaly(
+        df, mall_name, time_window_hours=time_window_hours, failure_threshold_percentage=failure_threshold_percentage)
+    return is_anomaly, message, []
+
+def detect_unusual_transaction_patterns_logic(df, amount_std_dev_multiplier=3):
+    import workflow_anomaly_detection
+    unusual_df = workflow_anomaly_detection.detect_unusual_transaction_patterns(df, amount_std_dev_multiplier=amount_std_dev_multiplier)
+    return unusual_df, f"Found {len(unusual_df)} transactions with unusual amounts."
+
+# --- Server and load generator ---
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server(shim_dir, data_dir, port, extra_env=None):
+    """Starts main_fastApi under uvicorn with the shim modules first on the path; waits until it answers."""
+    import httpx
+
+    env = dict(os.environ, **(extra_env or {}))
+    env["PYTHONPATH"] = os.pathsep.join([shim_dir, PROJECT_ROOT] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    env[FIXTURE_DATA_DIR_ENV] = data_dir
+    env.setdefault("ADVISOR_SNAPSHOT_DIR", os.path.join(data_dir, "snapshots"))  # Keep the fixture's snapshots with its data
+    env.setdefault("ADVISOR_LOG_LEVEL", "WARNING")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main_fastApi:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=PROJECT_ROOT, env=env)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"API server exited during startup (code {server.returncode})")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/stats", timeout=1).status_code == 200:
+                return server
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f"API server did not start within {SERVER_START_TIMEOUT_SECONDS}s")
+
+def percentile(values, pct):
+    """None when there are no values (every request failed or timed out)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+async def drive_endpoint(base_url, endpoint, concurrency, duration_seconds, session_ids=False):
+    """Closed loop: `concurrency` clients each send their next request as soon as the previous one returns.
+
+    Latencies cover the requests that got a response; timeouts and connection errors are counted
+    under their exception name in status_counts instead.
+    """
+    import httpx
+
+    latencies, statuses = [], {}
+    deadline = time.perf_counter() + duration_seconds
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=30, limits=limits) as client:
+        async def client_loop(client_number):
+            sent = 0
+            session_id = (await client.post("/sessions")).json()["session_id"] if session_ids else None
+            while time.perf_counter() < deadline:
+                form = None
+                if endpoint == "/query":
+                    form = {"query_text": QUERY_MIX[(client_number + sent) % len(QUERY_MIX)]}
+                    if session_id:
+                        form["session_id"] = session_id
+                sent += 1
+                started = time.perf_counter()
+                try:
+                    response = await client.post(endpoint, data=form)
+                except httpx.TransportError as e:
+                    statuses[type(e).__name__] = statuses.get(type(e).__name__, 0) + 1
+                    continue
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        wall_started = time.perf_counter()
+        await asyncio.gather(*(client_loop(i) for i in range(concurrency)))
+        wall_seconds = time.perf_counter() - wall_started
+    requests = sum(statuses.values())
+    successes = sum(count for status, count in statuses.items() if isinstance(status, int) and status < 400)
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": requests,
+        "successes": successes,
+        "errors": requests - successes,
+        "throughput_rps": round(requests / wall_seconds, 1),
+        **{f"p{pct}_ms": _milliseconds(percentile(latencies, pct)) for pct in (50, 95, 99)},
+        "status_counts": {str(status): count for status, count in sorted(statuses.items(), key=lambda item: str(item[0]))},
+    }
+
+def _milliseconds(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+def compare_to_baseline(results, baseline, max_regression):
+    """Lists endpoints whose p95 or throughput got worse than the baseline by more than max_regression."""
+    regressions = []
+    for result in results:
+        previous = next((b for b in baseline if b["endpoint"] == result["endpoint"]), None)
+        if previous is None:
+            continue
+        if result["p95_ms"] is None:
+            regressions.append(f"{result['endpoint']}: no responses ({result['errors']} errors)")
+            continue
+        if previous["p95_ms"] is not None and result["p95_ms"] > previous["p95_ms"] * (1 + max_regression):
+            regressions.append(f"{result['endpoint']}: p95 {previous['p95_ms']}ms -> {result['p95_ms']}ms")
+        if result["throughput_rps"] < previous["throughput_rps"] * (1 - max_regression):
+            regressions.append(f"{result['endpoint']}: throughput {previous['throughput_rps']} -> {result['throughput_rps']} req/s")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline end-to-end load test of main_fastApi with a synthetic fixture and a hash embedder.")
+    parser.add_argument("--rows", type=int, default=50_000, help="Synthetic transactions in the fixture")
+    parser.add_argument("--months", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="Where the fixture and shim modules go (default: a new temp dir)")
+    parser.add_argument("--reuse-fixture", action="store_true", help="Skip building the fixture if --workdir already has one")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent /query clients")
+    parser.add_argument("--anomaly-concurrency", type=int, default=2, help="Concurrent /run_anomaly_detection clients")
+    parser.add_argument("--duration", type=float, default=15, help="Seconds per endpoint")
+    parser.add_argument("--warmup", type=float, default=3, help="Unmeasured seconds per endpoint first (pool spawn, caches)")
+    parser.add_argument("--sessions", action="store_true", help="Send a session_id per client (conversational path)")
+    parser.add_argument("--save", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Results JSON from an earlier run; exit 1 if this run regressed")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed relative regression vs --baseline")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="advisor-load-")
+    shim_dir, data_dir = os.path.join(workdir, "shim"), os.path.join(workdir, "data")
+    write_shim_modules(shim_dir)
+    sys.path.insert(0, shim_dir)  # data_ingestion_p2 imports sentence_transformers too
+    if not (args.reuse_fixture and os.path.exists(os.path.join(data_dir, "transaction_index.faiss"))):
+        fixture_started = time.perf_counter()
+        fixture_rows = build_fixture(data_dir, args.rows, months=args.months, seed=args.seed)
+        print(f"Fixture: {fixture_rows} transactions in {data_dir} ({time.perf_counter() - fixture_started:.1f}s)")
+
+    port = free_port()
+    server = start_server(shim_dir, data_dir, port)
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        if args.warmup > 0:
+            asyncio.run(drive_endpoint(base_url, "/query", args.concurrency, args.warmup))
+            asyncio.run(drive_endpoint(base_url, "/run_anomaly_detection", args.anomaly_concurrency, args.warmup))
+        results = [
+            asyncio.run(drive_endpoint(base_url, "/query", args.concurrency, args.duration, session_ids=args.sessions)),
+            asyncio.run(drive_endpoint(base_url, "/run_anomaly_detection", args.anomaly_concurrency, args.duration)),
+        ]
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+    print(f"{'endpoint':<24}{'clients':>8}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}  statuses")
+    for result in results:
+        p50, p95, p99 = (str(result[key]) if result[key] is not None else "n/a" for key in ("p50_ms", "p95_ms", "p99_ms"))
+        print(f"{result['endpoint']:<24}{result['concurrency']:>8}{result['requests']:>10}{result['errors']:>8}{result['throughput_rps']:>10}"
+              f"{p50:>10}{p95:>10}{p99:>10}  {result['status_counts']}")
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
@@ -1,10 +1,22 @@
+import asyncio
+import logging
 import os
 import sys
+import time
 from fastapi import FastAPI, Form, Request, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
+import numpy as np
 import pandas as pd
 
+# --- Logging: level-gated, key=value lines (ADVISOR_LOG_LEVEL=DEBUG shows per-query details) ---
+logging.basicConfig(
+    level=os.environ.get("ADVISOR_LOG_LEVEL", "INFO").upper(),
+    format='ts=%(asctime)s level=%(levelname)s logger=%(name)s msg="%(message)s"'
+)
+logger = logging.getLogger("advisor.api")
+
 # --- Add src to sys.path ---
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
 SRC_DIR = os.path.join(PROJECT_ROOT, "src")
@@ -15,38 +27,417 @@ if SRC_DIR not in sys.path:
 try:
     from src.advisor_logic import (
         load_all_models_once,
-        semantic_search_transactions,
+        get_data_version,
+        get_table_change_id,
+        load_transactions_since,
+        semantic_search_transactions_batch,
+        find_similar_transactions,
+        get_index_encoder,
         get_transaction_details_by_ids_logic,
         load_data_from_sql_for_anomaly,
         detect_failed_transaction_anomaly_logic,
         detect_unusual_transaction_patterns_logic
     )
 except ImportError as e:
-    print(f"Critical Error: Could not import from advisor_logic.py: {e}")
-    print(f"Please ensure 'advisor_logic.py' exists in the '{SRC_DIR}' directory and has no import errors itself.")
-    print("Current sys.path:", sys.path)
+    logger.critical("Could not import from advisor_logic.py: %s", e)
+    logger.critical("Please ensure 'advisor_logic.py' exists in the '%s' directory and has no import errors itself.", SRC_DIR)
+    logger.critical("Current sys.path: %s", sys.path)
     sys.exit(1)
 
-app = FastAPI(title="Smart Financial Advisor API")
+from api_concurrency import PoolSaturatedError, create_thread_pool, create_process_pool
+from query_batcher import QueryBatcher
+from olap_cube import TransactionCube
+from query_router import AGGREGATE, LOOKUP, extract_filters, parse_time_range, route_query
+from conversation_memory import SessionStore, UnknownSessionError, CANDIDATE_POOL_SIZE, filter_candidates, is_follow_up, merge_context
+from workflow_anomaly_detection import detect_duplicate_transaction_clusters, detect_fuzzy_duplicate_clusters, detect_structural_outliers
+from analytics_snapshot import current_snapshot, refresh_snapshot
+from advisor_metrics import (
+    REQUEST_DURATION,
+    record_stage,
+    render_metrics,
+    server_timing_header,
+    stage_timer,
+    start_request_timings,
+)
+from api_serialization import (
+    FastJSONResponse,
+    frame_to_payload,
+    make_etag,
+    etag_matches,
+    not_modified,
+    RESPONSE_FORMATS,
+    GZIP_MIN_BYTES,
+)
+
+# Anomaly results depend on "now" (rolling time windows), so their ETag also rolls over this often.
+ANOMALY_ETAG_TTL_SECONDS = 60
+# Near-duplicate workflow: gap allowed between repeats, and how many clusters a response lists.
+DUPLICATE_TIME_TOLERANCE_MINUTES = 10
+DUPLICATE_CLUSTERS_LIMIT = 50
+# Opt-in fuzzy variant (amounts within FUZZY_AMOUNT_TOLERANCE): a FAISS range search, much dearer than the exact sweep.
+FUZZY_DUPLICATES_ENABLED = os.environ.get("ADVISOR_FUZZY_DUPLICATES", "0") == "1"
+FUZZY_AMOUNT_TOLERANCE = 0.02
+# Structured-feature endpoints: largest k accepted, and how many outliers a response lists.
+MAX_NEIGHBOURS = 100
+STRUCTURAL_OUTLIERS_LIMIT = 50
+# After a failed cube/snapshot refresh, requests for the same data version wait this long before retrying.
+CUBE_REFRESH_RETRY_SECONDS = 30
+
+app = FastAPI(title="Smart Financial Advisor API", default_response_class=FastJSONResponse)
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_BYTES)
 
 STATIC_DIR_PATH = os.path.join(PROJECT_ROOT, "static")
 if not os.path.isdir(STATIC_DIR_PATH):
-    print(f"Warning: Static directory not found at {STATIC_DIR_PATH}. The frontend (main.html) might not be served.")
+    logger.warning("Static directory not found at %s. The frontend (main.html) might not be served.", STATIC_DIR_PATH)
 else:
     app.mount("/static_assets", StaticFiles(directory=STATIC_DIR_PATH), name="static_assets")
 
 models_initialized = False
+# Blocking work never runs on the event loop: encode/FAISS/sqlite go to io_pool, pandas anomaly work to cpu_pool.
+io_pool = None
+cpu_pool = None
+# Concurrent /query calls are coalesced into one encode + FAISS search per batch.
+query_batcher = None
+# Aggregate questions ("total sales per mall in April") are answered from this cube, not the vector index.
+transaction_cube = TransactionCube()
+cube_data_version = None
+cube_refresh_lock = asyncio.Lock()
+cube_refresh_failure = None  # (data_version, monotonic time) of the last failed refresh
+# The shared analytics snapshot is tracked apart from the cube: either can fail and be retried alone.
+snapshot_data_version = None
+snapshot_refresh_failure = None
+# Per-session turns (filters + candidate IDs) so follow-up questions narrow the previous answer.
+session_store = SessionStore()
+QUERY_RESULT_LIMIT = 5
+
+@app.middleware("http")
+async def instrument_request(request: Request, call_next):
+    """Times every request, exports it to /metrics and returns the stage breakdown as Server-Timing.
+
+    Send "X-Profile: 1" (with ADVISOR_PROFILING=1) to log a cProfile of the request's thread-pool work.
+    """
+    timings = start_request_timings(profile=request.headers.get("x-profile") == "1")
+    started = time.perf_counter()
+    response = await call_next(request)
+    total = time.perf_counter() - started
+    route = request.scope.get("route")
+    REQUEST_DURATION.observe(route.path if route is not None else "unmatched", total)
+    response.headers["Server-Timing"] = server_timing_header(timings + [("total", total)])
+    return response
 
 @app.on_event("startup")
 async def startup_event():
-    global models_initialized
-    print("FastAPI application startup: Attempting to load models...")
-    if load_all_models_once():
+    global models_initialized, io_pool, cpu_pool, query_batcher
+    io_pool = create_thread_pool()
+    cpu_pool = create_process_pool()
+    query_batcher = QueryBatcher(semantic_search_transactions_batch, io_pool)
+    logger.info("FastAPI application startup: Attempting to load models...")
+    if await io_pool.submit(load_all_models_once):
         models_initialized = True
-        print("Models loaded successfully.")
+        logger.info("Models loaded successfully.")
+        await ensure_cube_current()
     else:
         models_initialized = False
-        print("CRITICAL: Models failed to load during startup. Some endpoints may not function correctly.")
+        logger.critical("Models failed to load during startup. Some endpoints may not function correctly.")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for pool in (io_pool, cpu_pool):
+        if pool is not None:
+            pool.shutdown()
+
+def _service_busy(exc):
+    return HTTPException(
+        status_code=503,
+        detail=f"Service Unavailable: {exc}. Please retry shortly.",
+        headers={"Retry-After": "1"}
+    )
+
+def refresh_transaction_cube(cube):
+    """Folds rows appended since the last refresh into the cube. Runs on io_pool.
+
+    A fresh cube is built from scratch when existing rows changed instead: the table's change log
+    moved (rows updated or deleted in place, table replaced), the row counts no longer add up, or,
+    for a database without a change log, its files changed but no rows were appended.
+    Returns (cube, error_message).
+    """
+    # Read before the rows, so a change made while they load is picked up by the next refresh.
+    change_id, change_error = get_table_change_id()
+    if change_error:
+        return cube, change_error
+    new_rows, max_rowid, table_row_count, load_error = load_transactions_since(cube.last_rowid)
+    if load_error:
+        return cube, load_error
+    rows_changed = change_id != cube.change_id if change_id is not None else new_rows.empty
+    if cube.row_count + len(new_rows) != table_row_count or (cube.row_count and rows_changed):
+        cube = TransactionCube()
+        new_rows, max_rowid, table_row_count, load_error = load_transactions_since(0)
+        if load_error:
+            return cube, load_error
+    cube.change_id = change_id
+    added = cube.add_rows(new_rows, last_rowid=max_rowid)
+    logger.info("Transaction cube refreshed: +%d rows, %d total, version %s.", added, cube.row_count, cube.version)
+    return cube, None
+
+async def ensure_cube_current():
+    """Refreshes the cube and the shared analytics snapshot when the DB/index version changed.
+
+    Each is brought up to date on its own. A failed refresh is retried at most every
+    CUBE_REFRESH_RETRY_SECONDS for the same data version, so requests keep being served from the
+    previous cube (and SQL instead of a stale snapshot) rather than each queueing a full reload.
+    """
+    global transaction_cube, cube_data_version, cube_refresh_failure, snapshot_data_version, snapshot_refresh_failure
+    data_version = get_data_version()
+    if not any(_stale(data_version)):
+        return
+    async with cube_refresh_lock:
+        cube_stale, snapshot_stale = _stale(data_version)
+        if cube_stale:
+            cube, refresh_error = await io_pool.submit(refresh_transaction_cube, transaction_cube)
+            if refresh_error:
+                logger.error("%s", refresh_error)
+                cube_refresh_failure = (data_version, time.monotonic())
+            else:
+                transaction_cube, cube_data_version = cube, data_version
+        if snapshot_stale:
+            # Published to disk and memory-mapped, so process-pool and pre-forked workers read the same copy.
+            _, snapshot_error = await io_pool.submit(refresh_snapshot, load_transactions_since, data_version, get_table_change_id)
+            if snapshot_error:
+                logger.error("%s", snapshot_error)
+                snapshot_refresh_failure = (data_version, time.monotonic())
+            else:
+                snapshot_data_version = data_version
+
+def _stale(data_version):
+    """(cube, snapshot): whether each is behind data_version and not waiting out a recent failure."""
+    return (data_version != cube_data_version and not _recently_failed(cube_refresh_failure, data_version),
+            data_version != snapshot_data_version and not _recently_failed(snapshot_refresh_failure, data_version))
+
+def _recently_failed(failure, data_version):
+    return (failure is not None and failure[0] == data_version
+            and time.monotonic() - failure[1] < CUBE_REFRESH_RETRY_SECONDS)
+
+def format_aggregate_report(spec, report, follow_up=False):
+    return {
+        "intent": AGGREGATE,
+        "follow_up": follow_up,
+        "measure": spec["measure"],
+        "group_by": spec["group_by"],
+        "filters": spec["filters"],
+        "start": spec["start"].strftime("%Y-%m-%d") if spec["start"] is not None else None,
+        "end": spec["end"].strftime("%Y-%m-%d") if spec["end"] is not None else None,
+        "rows": report["rows"],
+        "total": report["total"],
+    }
+
+def _check_response_format(response_format):
+    if response_format not in RESPONSE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"response_format must be one of {', '.join(RESPONSE_FORMATS)}.")
+
+def get_transaction_details(transaction_ids, start=None, end=None):
+    """Detail rows for transaction IDs from the analytics snapshot; SQL only for IDs it does not have yet.
+
+    A snapshot behind the current data version (its refresh failed or is still running) is skipped,
+    so rows changed since it was published are never served from it.
+    start/end is the search's time range, so partitioned storage only opens those months.
+    Returns (details_df, error_message) like get_transaction_details_by_ids_logic.
+    """
+    snapshot = current_snapshot()
+    if snapshot is None or snapshot.version != get_data_version():
+        return get_transaction_details_by_ids_logic(transaction_ids, start, end)
+    with stage_timer("snapshot_lookup"):
+        details_df, missing_ids = snapshot.details_for_ids(transaction_ids)
+    if missing_ids:
+        missing_df, details_error = get_transaction_details_by_ids_logic(missing_ids, start, end)
+        if details_error and details_df.empty:
+            return missing_df, details_error
+        if not details_error:
+            details_df = pd.concat([details_df, missing_df], ignore_index=True)
+    return details_df, None
+
+def fetch_query_details(semantic_results, response_format="records", start=None, end=None):
+    """Blocking SQL part of /query: fetches and ranks details for the search hits. Runs on io_pool.
+
+    Returns (transactions_details, error_message).
+    """
+    retrieved_ids = [res["transaction_id"] for res in semantic_results]
+    details_df, details_error = get_transaction_details(retrieved_ids, start, end)
+    if details_error:
+        return None, f"Error fetching transaction details: {details_error}"
+    score_map = {res["transaction_id"]: res["score"] for res in semantic_results}
+    return frame_to_payload(_rank_by_score(details_df, score_map), response_format), None
+
+def _rank_by_score(details_df, score_map):
+    scores = details_df["transaction_id"].map(score_map).to_numpy(dtype="float64")
+    order = np.argsort(-np.nan_to_num(scores, nan=0.0), kind="stable")
+    return details_df.iloc[order].assign(semantic_score=scores[order])
+
+def narrow_candidates(candidates, filters, start, end, response_format="records"):
+    """Applies a follow-up's filters to a remembered candidate set instead of searching again. Runs on io_pool.
+
+    candidates is a list of (transaction_id, score) from the session's original search.
+    Returns (top transactions, number of candidates that matched, error_message).
+    """
+    if not candidates:
+        return frame_to_payload(pd.DataFrame(), response_format), 0, None
+    details_df, details_error = get_transaction_details([transaction_id for transaction_id, _ in candidates])
+    if details_error:
+        return None, 0, f"Error fetching transaction details: {details_error}"
+    narrowed_df = filter_candidates(details_df, filters, start, end)
+    ranked_df = _rank_by_score(narrowed_df, dict(candidates))
+    return frame_to_payload(ranked_df.head(QUERY_RESULT_LIMIT), response_format), len(narrowed_df), None
+
+async def answer_follow_up(session_id, previous_turn, query_text, response_format):
+    """Answers "only the failed ones" / "what about last week" from the previous turn's context."""
+    text = query_text.lower()
+    new_filters = extract_filters(text, transaction_cube.dimension_values("mall_name"), transaction_cube.dimension_values("branch_name"))
+    start, end = parse_time_range(text, transaction_cube.max_date) if transaction_cube.max_date is not None else (None, None)
+    filters, start, end = merge_context(previous_turn, new_filters, start, end)
+    if previous_turn["intent"] == AGGREGATE:
+        report_spec = dict(previous_turn["spec"], filters=filters, start=start, end=end)
+        with stage_timer("cube_report"):
+            report = transaction_cube.report(**report_spec)
+        session_store.add_turn(session_id, {"query": query_text, "intent": AGGREGATE, "spec": report_spec,
+                                            "filters": filters, "start": start, "end": end})
+        return format_aggregate_report(report_spec, report, follow_up=True)
+    candidates = previous_turn["candidates"]
+    transactions_details, matched, details_error = await io_pool.submit(
+        narrow_candidates, candidates, filters, start, end, response_format)
+    if details_error:
+        logger.error("%s", details_error)
+        raise HTTPException(status_code=500, detail=details_error)
+    session_store.add_turn(session_id, {"query": query_text, "intent": LOOKUP, "candidates": candidates,
+                                        "filters": filters, "start": start, "end": end})
+    content = {
+        "follow_up": True,
+        "filters": filters,
+        "start": start.strftime("%Y-%m-%d") if start is not None else None,
+        "end": end.strftime("%Y-%m-%d") if end is not None else None,
+        "matched": matched,
+        "transactions": transactions_details,
+    }
+    if not matched:
+        content["message"] = "None of the previous results match this follow-up. Ask a new question to search again."
+    return content
+
+def load_workflow_frame(data_version):
+    """All transactions for the process-pool workflows: the shared snapshot when current, else a SQL load.
+
+    data_version comes from the parent process: a spawned worker has no retrieval components loaded
+    (no partition store), so its own get_data_version() would not match the published snapshot.
+    Snapshot frames carry no transaction_id column; decode reported rows with with_transaction_ids().
+    Returns (snapshot or None when SQL was used, transaction_df, error_message).
+    """
+    snapshot = current_snapshot()
+    if snapshot is not None and snapshot.version == data_version:
+        # Views over the shared, memory-mapped snapshot instead of a fresh SQL load. The workflows
+        # only filter and add columns, so no defensive copies are needed.
+        return snapshot, snapshot.frame(), None
+    transaction_df, load_error = load_data_from_sql_for_anomaly()
+    if load_error:
+        return None, None, f"Failed to load data for anomaly detection: {load_error}"
+    return None, transaction_df, None
+
+def with_transaction_ids(df, snapshot):
+    """Adds transaction_id to a result computed on a snapshot frame (its index holds snapshot row positions)."""
+    return df.assign(transaction_id=snapshot.transaction_ids(df.index)) if snapshot is not None else df
+
+def run_anomaly_workflows(response_format="records", data_version=None):
+    """Blocking part of /run_anomaly_detection (SQL load + pandas workflows). Runs on cpu_pool.
+
+    Must stay a module-level function so the process pool can pickle it.
+    Returns (results_payload, error_message).
+    """
+    results_payload = {
+        "anomaly_results": [],
+        "unusual_transactions": [],
+        "duplicate_clusters": [],
+        "fuzzy_duplicate_clusters": []
+    }
+    snapshot, transaction_df, load_error = load_workflow_frame(data_version)
+    if load_error:
+        return None, load_error
+    if snapshot is not None:
+        recent_z_mall_df = snapshot.frame(snapshot.mall_rows("Z Mall", start=pd.Timestamp.now() - pd.Timedelta(hours=7*24)))
+    else:
+        recent_z_mall_df = transaction_df
+    if transaction_df is None or transaction_df.empty:
+        return results_payload, None
+    is_failed_anomaly, failed_message, _ = detect_failed_transaction_anomaly_logic(
+        recent_z_mall_df,
+        mall_name="Z Mall",
+        time_window_hours=7*24,
+        failure_threshold_percentage=10
+    )
+    results_payload["anomaly_results"].append({
+        "workflow": "Failed Transaction Rate (Z Mall, last 7 days, >10%)", 
+        "status": "ALERT" if is_failed_anomaly else "Normal", 
+        "message": failed_message
+    })
+    unusual_amounts_df, unusual_message = detect_unusual_transaction_patterns_logic(
+        transaction_df,
+        amount_std_dev_multiplier=2.5
+    )
+    results_payload["anomaly_results"].append({
+        "workflow": "Unusual Transaction Amounts (Overall, >2.5 Std Dev)", 
+        "status": "ALERT" if not unusual_amounts_df.empty else "Normal", 
+        "message": unusual_message
+    })
+    if not unusual_amounts_df.empty:
+        unusual_amounts_df = with_transaction_ids(unusual_amounts_df, snapshot)
+        # Datetime columns are rendered as ISO strings by frame_to_payload, so a rename is all that's needed.
+        if 'transaction_date' in unusual_amounts_df.columns and 'transaction_date_iso' not in unusual_amounts_df.columns:
+            unusual_amounts_df = unusual_amounts_df.rename(columns={'transaction_date': 'transaction_date_iso'})
+        cols_for_frontend = ['transaction_id', 'mall_name', 'branch_name', 'transaction_date_iso', 'transaction_amount', 'transaction_status']
+        existing_cols = [col for col in cols_for_frontend if col in unusual_amounts_df.columns]
+        results_payload["unusual_transactions"] = frame_to_payload(unusual_amounts_df[existing_cols], response_format)
+    duplicate_clusters_df = detect_duplicate_transaction_clusters(transaction_df, time_tolerance_minutes=DUPLICATE_TIME_TOLERANCE_MINUTES)
+    results_payload["anomaly_results"].append({
+        "workflow": f"Near-Duplicate Transactions (same branch/type/amount within {DUPLICATE_TIME_TOLERANCE_MINUTES} min)",
+        "status": "ALERT" if not duplicate_clusters_df.empty else "Normal",
+        "message": (f"Found {len(duplicate_clusters_df)} clusters ({int(duplicate_clusters_df['size'].sum())} transactions): "
+                    f"{int((duplicate_clusters_df['pattern'] == 'retry_storm').sum())} retry storms, "
+                    f"{int((duplicate_clusters_df['pattern'] == 'possible_double_charge').sum())} possible double charges."
+                    if not duplicate_clusters_df.empty else "No near-duplicate transaction clusters found.")
+    })
+    if not duplicate_clusters_df.empty:
+        results_payload["duplicate_clusters"] = frame_to_payload(_returned_clusters(duplicate_clusters_df, snapshot), response_format)
+    if FUZZY_DUPLICATES_ENABLED:
+        fuzzy_clusters_df = detect_fuzzy_duplicate_clusters(transaction_df, amount_tolerance_ratio=FUZZY_AMOUNT_TOLERANCE,
+                                                            time_tolerance_minutes=DUPLICATE_TIME_TOLERANCE_MINUTES)
+        results_payload["anomaly_results"].append({
+            "workflow": f"Fuzzy Near-Duplicates (same branch/type, amounts within {FUZZY_AMOUNT_TOLERANCE:.0%}, {DUPLICATE_TIME_TOLERANCE_MINUTES} min)",
+            "status": "ALERT" if not fuzzy_clusters_df.empty else "Normal",
+            "message": (f"Found {len(fuzzy_clusters_df)} clusters ({int(fuzzy_clusters_df['size'].sum())} transactions)."
+                        if not fuzzy_clusters_df.empty else "No fuzzy near-duplicate clusters found.")
+        })
+        if not fuzzy_clusters_df.empty:
+            results_payload["fuzzy_duplicate_clusters"] = frame_to_payload(_returned_clusters(fuzzy_clusters_df, snapshot), response_format)
+    return results_payload, None
+
+def _returned_clusters(clusters_df, snapshot):
+    """The first DUPLICATE_CLUSTERS_LIMIT clusters; snapshot clusters list row positions, decoded only for these."""
+    clusters_df = clusters_df.head(DUPLICATE_CLUSTERS_LIMIT)
+    if snapshot is None:
+        return clusters_df
+    return clusters_df.assign(transaction_ids=[snapshot.transaction_ids(positions).tolist() for positions in clusters_df['transaction_ids']])
+
+def run_structural_outliers(k, score_quantile, encoder, response_format="records", data_version=None):
+    """Blocking part of /structural_outliers. Runs on cpu_pool, so it is module-level like run_anomaly_workflows.
+
+    encoder is the structured index's encoder from the parent process (None for a text index).
+    Returns (outliers_payload, number_of_outliers, error_message).
+    """
+    snapshot, transaction_df, load_error = load_workflow_frame(data_version)
+    if load_error:
+        return None, 0, load_error
+    outliers_df = detect_structural_outliers(transaction_df, k=k, score_quantile=score_quantile, encoder=encoder)
+    outlier_count = len(outliers_df)
+    outliers_df = with_transaction_ids(outliers_df.head(STRUCTURAL_OUTLIERS_LIMIT), snapshot)
+    columns = ['transaction_id', 'mall_name', 'branch_name', 'transaction_type', 'transaction_date',
+               'transaction_amount', 'transaction_status', 'outlier_score']
+    outliers_df = outliers_df[[column for column in columns if column in outliers_df.columns]]
+    return frame_to_payload(outliers_df, response_format), outlier_count, None
 
 @app.get("/", response_class=HTMLResponse)
 async def serve_main_html(request: Request): # Renamed function for clarity, optional
@@ -61,8 +452,7 @@ async def serve_main_html(request: Request): # Renamed function for clarity, opt
         html_content = f.read()
     return HTMLResponse(content=html_content)
 
-@app.post("/query", response_class=JSONResponse)
-async def handle_transaction_query_api(query_text: str = Form(...)):
+def _check_query_request(query_text, response_format):
     if not models_initialized:
         raise HTTPException(
             status_code=503, 
@@ -70,83 +460,243 @@ async def handle_transaction_query_api(query_text: str = Form(...)):
         )
     if not query_text or not query_text.strip():
         raise HTTPException(status_code=400, detail="Query text cannot be empty.")
+    _check_response_format(response_format)
+
+def query_etag(query_text, response_format, session_id=None):
+    # Identical query + format against the same DB/index build returns the same body. Inside a
+    # session the answer also depends on the history, so the session's turn sequence is part of the key.
+    session_sequence = session_store.sequence(session_id) if session_id else 0
+    return make_etag(get_data_version(), "query", query_text.strip(), response_format, session_id, session_sequence)
+
+def _check_session(session_id):
+    """Rejects ids this process never issued or has expired, instead of silently starting a fresh search."""
+    if session_id not in session_store:
+        raise _unknown_session(session_id)
+
+def _unknown_session(session_id):
+    if not SessionStore.issued_by_this_process(session_id):
+        # Sessions live in one process: under prefork_server.py another worker may hold this one.
+        detail = ("Unknown session_id for this server process. Sessions are kept per worker; send a conversation's "
+                  "requests to the worker that issued its session (sticky routing or a single worker), or start a new session.")
+    else:
+        detail = "Unknown or expired session_id. Start a new session with POST /sessions."
+    return HTTPException(status_code=404, detail=detail)
+
+@app.post("/sessions", response_class=FastJSONResponse)
+async def create_session_api():
+    """Issues a session_id for conversational /query calls (follow-ups refine the previous answer)."""
+    return FastJSONResponse(content={"session_id": session_store.create_session(), "ttl_seconds": session_store.ttl_seconds})
+
+@app.post("/query", response_class=FastJSONResponse)
+async def handle_transaction_query_api(query_text: str = Form(...), session_id: str = Form(None), response_format: str = "records"):
+    """Answers a question. With a session_id from POST /sessions, follow-ups ("only the failed ones") refine the previous answer.
+
+    POST is never answered with 304 (If-None-Match on a POST calls for 412, and caches do not
+    revalidate POSTs); cacheable, session-less questions go through GET /query instead.
+    """
+    _check_query_request(query_text, response_format)
+    session_id = session_id.strip() if session_id and session_id.strip() else None
+    if session_id is not None:
+        _check_session(session_id)
+    return await answer_query(query_text, session_id, response_format, query_etag(query_text, response_format, session_id))
+
+@app.get("/query", response_class=FastJSONResponse)
+async def query_get_api(request: Request, query_text: str, response_format: str = "records"):
+    """Session-less /query for caches and conditional requests: a matching If-None-Match gets 304."""
+    _check_query_request(query_text, response_format)
+    etag = query_etag(query_text, response_format)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    return await answer_query(query_text, None, response_format, etag)
+
+async def answer_query(query_text, session_id, response_format, etag):
     try:
-        semantic_results, search_error = semantic_search_transactions(query_text, k=5)
+        await ensure_cube_current()
+        previous_turn = session_store.last_turn(session_id) if session_id else None
+        if previous_turn is not None and is_follow_up(query_text):
+            content = await answer_follow_up(session_id, previous_turn, query_text, response_format)
+            return FastJSONResponse(content=content, headers={"ETag": etag})
+        intent, report_spec = route_query(query_text, transaction_cube)
+        if intent == AGGREGATE:
+            with stage_timer("cube_report"):
+                report = transaction_cube.report(**report_spec)
+            if session_id:
+                session_store.add_turn(session_id, {"query": query_text, "intent": AGGREGATE, "spec": report_spec,
+                                                    "filters": report_spec["filters"], "start": report_spec["start"], "end": report_spec["end"]})
+            return FastJSONResponse(content=format_aggregate_report(report_spec, report), headers={"ETag": etag})
+        # In a session, keep a larger ranked pool so follow-ups have something to narrow.
+        search_k = CANDIDATE_POOL_SIZE if session_id else QUERY_RESULT_LIMIT
+        # Dates in the question ("last month", "in March") route partitioned storage to those months;
+        # without any, only the hot months are searched.
+        start, end = parse_time_range(query_text.lower(), transaction_cube.max_date) if transaction_cube.max_date is not None else (None, None)
+        semantic_results, search_error = await query_batcher.search(query_text, k=search_k, start=start, end=end)
         if search_error:
-            print(f"Error during semantic search: {search_error}")
+            logger.error("Error during semantic search: %s", search_error)
             raise HTTPException(status_code=500, detail=f"Error during semantic search: {search_error}")
+        if session_id:
+            # The question's range is kept, so "only the failed ones" stays within the same dates.
+            session_store.add_turn(session_id, {"query": query_text, "intent": LOOKUP, "filters": {}, "start": start, "end": end,
+                                                "candidates": [(res["transaction_id"], res["score"]) for res in semantic_results]})
         if not semantic_results:
-            return JSONResponse(content={"message": "No relevant transactions found for your query."})
-        retrieved_ids = [res["transaction_id"] for res in semantic_results]
-        details_df, details_error = get_transaction_details_by_ids_logic(retrieved_ids)
+            return FastJSONResponse(content={"message": "No relevant transactions found for your query."}, headers={"ETag": etag})
+        transactions_details, details_error = await io_pool.submit(
+            fetch_query_details, semantic_results[:QUERY_RESULT_LIMIT], response_format, start, end)
         if details_error:
-            print(f"Error fetching transaction details: {details_error}")
-            raise HTTPException(status_code=500, detail=f"Error fetching transaction details: {details_error}")
-        transactions_details = details_df.to_dict(orient="records")
-        score_map = {res["transaction_id"]: res["score"] for res in semantic_results}
-        for detail in transactions_details:
-            detail["semantic_score"] = score_map.get(detail["transaction_id"])
-        transactions_details.sort(key=lambda x: x.get("semantic_score", 0) or 0, reverse=True)
-        return JSONResponse(content={"transactions": transactions_details})
+            logger.error("%s", details_error)
+            raise HTTPException(status_code=500, detail=details_error)
+        return FastJSONResponse(content={"transactions": transactions_details}, headers={"ETag": etag})
+    except PoolSaturatedError as e:
+        raise _service_busy(e)
+    except UnknownSessionError:
+        # Expired or evicted while the request ran: not silently recreated as an empty session.
+        raise _unknown_session(session_id)
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Unexpected error in /query endpoint: {e}")
+        logger.exception("Unexpected error in /query endpoint: %s", e)
         raise HTTPException(status_code=500, detail="An unexpected internal server error occurred.")
 
-@app.post("/run_anomaly_detection", response_class=JSONResponse)
-async def run_anomaly_detection_workflows_api():
+def _check_anomaly_request(response_format):
     if not models_initialized:
         raise HTTPException(
             status_code=503, 
             detail="Service Unavailable: Models are not initialized. Please try again shortly."
         )
-    results_payload = {
-        "anomaly_results": [],
-        "unusual_transactions": []
-    }
+    _check_response_format(response_format)
+
+def anomaly_etag(response_format):
+    time_bucket = int(time.time() // ANOMALY_ETAG_TTL_SECONDS)
+    return make_etag(get_data_version(), "anomaly", time_bucket, response_format)
+
+@app.post("/run_anomaly_detection", response_class=FastJSONResponse)
+async def run_anomaly_detection_workflows_api(response_format: str = "records"):
+    """Runs the anomaly workflows. Like POST /query it never answers 304; GET /run_anomaly_detection does."""
+    _check_anomaly_request(response_format)
+    return await run_anomaly_detection(response_format, anomaly_etag(response_format))
+
+@app.get("/run_anomaly_detection", response_class=FastJSONResponse)
+async def run_anomaly_detection_get_api(request: Request, response_format: str = "records"):
+    """Read-only anomaly report for caches and conditional requests: a matching If-None-Match gets 304."""
+    _check_anomaly_request(response_format)
+    etag = anomaly_etag(response_format)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    return await run_anomaly_detection(response_format, etag)
+
+async def run_anomaly_detection(response_format, etag):
     try:
-        transaction_df, load_error = load_data_from_sql_for_anomaly()
-        if load_error:
-            print(f"Error loading data for anomaly detection: {load_error}")
-            raise HTTPException(status_code=500, detail=f"Failed to load data for anomaly detection: {load_error}")
-        if transaction_df is None or transaction_df.empty:
-            return JSONResponse(content=results_payload)
-        is_failed_anomaly, failed_message, _ = detect_failed_transaction_anomaly_logic(
-            transaction_df.copy(),
-            mall_name="Z Mall",
-            time_window_hours=7*24,
-            failure_threshold_percentage=10
-        )
-        results_payload["anomaly_results"].append({
-            "workflow": "Failed Transaction Rate (Z Mall, last 7 days, >10%)", 
-            "status": "ALERT" if is_failed_anomaly else "Normal", 
-            "message": failed_message
-        })
-        unusual_amounts_df, unusual_message = detect_unusual_transaction_patterns_logic(
-            transaction_df.copy(),
-            amount_std_dev_multiplier=2.5
-        )
-        results_payload["anomaly_results"].append({
-            "workflow": "Unusual Transaction Amounts (Overall, >2.5 Std Dev)", 
-            "status": "ALERT" if not unusual_amounts_df.empty else "Normal", 
-            "message": unusual_message
-        })
-        if not unusual_amounts_df.empty:
-            if 'transaction_date' in unusual_amounts_df.columns and 'transaction_date_iso' not in unusual_amounts_df.columns:
-                 if pd.api.types.is_datetime64_any_dtype(unusual_amounts_df['transaction_date']):
-                    unusual_amounts_df['transaction_date_iso'] = unusual_amounts_df['transaction_date'].apply(lambda x: x.isoformat() if pd.notnull(x) else None)
-                 else:
-                    unusual_amounts_df.rename(columns={'transaction_date': 'transaction_date_iso'}, inplace=True)
-            cols_for_frontend = ['transaction_id', 'mall_name', 'branch_name', 'transaction_date_iso', 'transaction_amount', 'transaction_status']
-            existing_cols = [col for col in cols_for_frontend if col in unusual_amounts_df.columns]
-            results_payload["unusual_transactions"] = unusual_amounts_df[existing_cols].to_dict(orient="records")
-        return JSONResponse(content=results_payload)
+        await ensure_cube_current()
+        # The workflows run in another process, so they are timed here as a single stage.
+        compute_started = time.perf_counter()
+        results_payload, workflow_error = await cpu_pool.submit(run_anomaly_workflows, response_format, get_data_version())
+        record_stage("anomaly_compute", time.perf_counter() - compute_started)
+        if workflow_error:
+            logger.error("%s", workflow_error)
+            raise HTTPException(status_code=500, detail=workflow_error)
+        return FastJSONResponse(content=results_payload, headers={"ETag": etag})
+    except PoolSaturatedError as e:
+        raise _service_busy(e)
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Unexpected error in /run_anomaly_detection endpoint: {e}")
+        logger.exception("Unexpected error in /run_anomaly_detection endpoint: %s", e)
         raise HTTPException(status_code=500, detail="An unexpected internal server error occurred during anomaly detection.")
+
+def _check_neighbours(k, response_format):
+    if not models_initialized:
+        raise HTTPException(
+            status_code=503,
+            detail="Service Unavailable: Models are not initialized. Please try again shortly."
+        )
+    if not 1 <= k <= MAX_NEIGHBOURS:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {MAX_NEIGHBOURS}.")
+    _check_response_format(response_format)
+
+@app.get("/transactions/{transaction_id}/similar", response_class=FastJSONResponse)
+async def similar_transactions_api(transaction_id: str, k: int = 5, response_format: str = "records"):
+    """Transactions nearest to an indexed one in the FAISS index ("transactions like this one"), for either encoder."""
+    _check_neighbours(k, response_format)
+    try:
+        similar_results, search_error = await io_pool.submit(find_similar_transactions, transaction_id, k)
+        if similar_results is None:
+            raise HTTPException(status_code=404, detail=search_error)
+        if search_error:
+            logger.error("%s", search_error)
+            raise HTTPException(status_code=500, detail=search_error)
+        if not similar_results:
+            return FastJSONResponse(content={"transaction_id": transaction_id, "transactions": []})
+        transactions_details, details_error = await io_pool.submit(fetch_query_details, similar_results, response_format)
+        if details_error:
+            logger.error("%s", details_error)
+            raise HTTPException(status_code=500, detail=details_error)
+        return FastJSONResponse(content={"transaction_id": transaction_id, "transactions": transactions_details})
+    except PoolSaturatedError as e:
+        raise _service_busy(e)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Unexpected error in /transactions/{transaction_id}/similar endpoint: %s", e)
+        raise HTTPException(status_code=500, detail="An unexpected internal server error occurred.")
+
+@app.get("/structural_outliers", response_class=FastJSONResponse)
+async def structural_outliers_api(k: int = 10, score_quantile: float = 0.99, response_format: str = "records"):
+    """Transactions far from their k nearest neighbours in structured-feature space (rare combinations).
+
+    Scored with the structured index's own encoder when there is one.
+    """
+    _check_neighbours(k, response_format)
+    if not 0 < score_quantile < 1:
+        raise HTTPException(status_code=400, detail="score_quantile must be between 0 and 1.")
+    try:
+        await ensure_cube_current()
+        compute_started = time.perf_counter()
+        outliers, outlier_count, workflow_error = await cpu_pool.submit(
+            run_structural_outliers, k, score_quantile, get_index_encoder(), response_format, get_data_version())
+        record_stage("outlier_compute", time.perf_counter() - compute_started)
+        if workflow_error:
+            logger.error("%s", workflow_error)
+            raise HTTPException(status_code=500, detail=workflow_error)
+        return FastJSONResponse(content={"k": k, "score_quantile": score_quantile, "outlier_count": outlier_count, "transactions": outliers})
+    except PoolSaturatedError as e:
+        raise _service_busy(e)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Unexpected error in /structural_outliers endpoint: %s", e)
+        raise HTTPException(status_code=500, detail="An unexpected internal server error occurred during outlier detection.")
+
+@app.get("/stats", response_class=JSONResponse)
+async def service_stats_api():
+    """Reports pool occupancy, achieved /query batch sizes and the analytics snapshot's memory footprint."""
+    snapshot = current_snapshot()
+    return JSONResponse(content={
+        "thread_pool": io_pool.stats() if io_pool else None,
+        "process_pool": cpu_pool.stats() if cpu_pool else None,
+        "query_batching": query_batcher.stats() if query_batcher else None,
+        "sessions": len(session_store),
+        "analytics_snapshot": snapshot.stats() if snapshot else None
+    })
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_api():
+    """Prometheus text exposition: stage/request latency histograms, batch sizes and pool gauges.
+
+    Values are per process; under prefork_server.py each worker exports its own.
+    """
+    pools = [pool for pool in (io_pool, cpu_pool) if pool is not None]
+    in_flight_lines = [
+        "# HELP advisor_pool_in_flight Jobs currently running or queued on a work pool.",
+        "# TYPE advisor_pool_in_flight gauge",
+    ] + [f'advisor_pool_in_flight{{pool="{pool.name}"}} {pool.in_flight}' for pool in pools]
+    rejected_lines = [
+        "# HELP advisor_pool_rejected_total Jobs rejected with 503 because the pool was saturated.",
+        "# TYPE advisor_pool_rejected_total counter",
+    ] + [f'advisor_pool_rejected_total{{pool="{pool.name}"}} {pool.rejected}' for pool in pools]
+    restart_lines = [
+        "# HELP advisor_pool_restarts_total Executors replaced after a worker process died.",
+        "# TYPE advisor_pool_restarts_total counter",
+    ] + [f'advisor_pool_restarts_total{{pool="{pool.name}"}} {pool.restarts}' for pool in pools]
+    return PlainTextResponse(render_metrics(["\n".join(in_flight_lines), "\n".join(rejected_lines), "\n".join(restart_lines)]),
+                             media_type="text/plain; version=0.0.4")
 # ... (startup_event where models_initialized is set) ...
 
 @app.post("/query", response_class=JSONResponse)
@@ -0,0 +1,187 @@
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+DIMENSIONS = ("mall_name", "branch_name", "transaction_type", "transaction_status")
+TIME_GRAINS = ("day", "week", "month")
+REPORT_CACHE_SIZE = 256
+
+class TransactionCube:
+    """Pre-aggregated transaction counts and sums over mall, branch, type, status and day.
+
+    Each cell holds (count, amount_sum, tax_sum) for one combination of the dimensions and one
+    calendar day, so the cube's size depends on the number of distinct combinations, not on the
+    number of transactions. Rows are folded in incrementally with add_rows(); week and month
+    totals are rolled up from days at query time. Reports are cached per cube version.
+    """
+
+    def __init__(self):
+        self._cells = {}  # (mall, branch, type, status, day_ordinal) -> [count, amount_sum, tax_sum]
+        self._lock = threading.Lock()
+        self._arrays = None
+        self._report_cache = OrderedDict()
+        self.version = 0
+        self.row_count = 0
+        self.last_rowid = 0  # Read position from load_transactions_since (a rowid, or {month: rows} for partitions)
+        self.change_id = None  # Source table's change-log position when its rows were read (see get_table_change_id)
+        self.min_date = None
+        self.max_date = None
+
+    def add_rows(self, df, last_rowid=None):
+        """Folds new transactions into the cube. Expects the transactions table's columns."""
+        if df is None or df.empty:
+            return 0
+        dates = pd.to_datetime(df["transaction_date"])
+        frame = df[list(DIMENSIONS)].copy()
+        frame["day"] = dates.dt.normalize().to_numpy().astype("datetime64[D]").astype("int64")
+        frame["transaction_amount"] = pd.to_numeric(df["transaction_amount"])
+        frame["tax_amount"] = pd.to_numeric(df["tax_amount"])
+        grouped = frame.groupby(list(DIMENSIONS) + ["day"], sort=False, dropna=False).agg(
+            count=("transaction_amount", "size"),
+            amount_sum=("transaction_amount", "sum"),
+            tax_sum=("tax_amount", "sum"),
+        )
+        with self._lock:
+            for key, count, amount_sum, tax_sum in zip(grouped.index, grouped["count"], grouped["amount_sum"], grouped["tax_sum"]):
+                cell = self._cells.get(key)
+                if cell is None:
+                    self._cells[key] = [int(count), float(amount_sum), float(tax_sum)]
+                else:
+                    cell[0] += int(count)
+                    cell[1] += float(amount_sum)
+                    cell[2] += float(tax_sum)
+            self.row_count += len(df)
+            if last_rowid is not None:
+                self.last_rowid = last_rowid
+            batch_min, batch_max = dates.min(), dates.max()
+            self.min_date = batch_min if self.min_date is None else min(self.min_date, batch_min)
+            self.max_date = batch_max if self.max_date is None else max(self.max_date, batch_max)
+            self.version += 1
+            self._arrays = None
+            self._report_cache.clear()
+        return len(df)
+
+    def dimension_values(self, dimension):
+        """Distinct values seen for a dimension (used by the query router to spot entity names)."""
+        position = DIMENSIONS.index(dimension)
+        with self._lock:
+            return sorted({key[position] for key in self._cells if isinstance(key[position], str)})
+
+    def _columnar(self):
+        """Cells as parallel numpy arrays (codes per dimension + measures), rebuilt once per version."""
+        with self._lock:
+            if self._arrays is not None:
+                return self._arrays
+            keys = list(self._cells)
+            values = np.array([self._cells[key] for key in keys], dtype="float64").reshape(-1, 3)
+            arrays = {"count": values[:, 0], "amount_sum": values[:, 1], "tax_sum": values[:, 2]}
+            for position, dimension in enumerate(DIMENSIONS):
+                labels, codes = np.unique(np.array([str(key[position]) for key in keys], dtype=object), return_inverse=True)
+                arrays[dimension] = (labels, codes)
+            arrays["day"] = np.array([key[-1] for key in keys], dtype="int64")
+            self._arrays = arrays
+            return arrays
+
+    def report(self, measure="count", group_by=(), filters=None, start=None, end=None):
+        """Aggregates the cube.
+
+        measure: count | total_amount | total_sales | total_tax | average_amount | refund_rate | failure_rate
+        group_by: any of DIMENSIONS plus day/week/month
+        filters: {dimension: value or list of values}; start/end: inclusive/exclusive pd.Timestamps
+        Returns {"rows": [...], "total": {...}} with one row per group.
+        """
+        filters = filters or {}
+        cache_key = (self.version, measure, tuple(group_by),
+                     tuple(sorted((k, tuple(v) if isinstance(v, (list, tuple)) else v) for k, v in filters.items())),
+                     start, end)
+        with self._lock:
+            cached = self._report_cache.get(cache_key)
+            if cached is not None:
+                self._report_cache.move_to_end(cache_key)
+                return cached
+
+        arrays = self._columnar()
+        mask = np.ones(len(arrays["day"]), dtype=bool)
+        for dimension, wanted in filters.items():
+            labels, codes = arrays[dimension]
+            wanted = [wanted] if isinstance(wanted, str) else list(wanted)
+            mask &= np.isin(codes, np.flatnonzero(np.isin(labels, wanted)))
+        if start is not None:
+            mask &= arrays["day"] >= np.datetime64(pd.Timestamp(start).normalize(), "D").astype("int64")
+        if end is not None:
+            mask &= arrays["day"] < np.datetime64(pd.Timestamp(end).normalize(), "D").astype("int64")
+
+        group_columns = []
+        for grain in group_by:
+            if grain in DIMENSIONS:
+                labels, codes = arrays[grain]
+                group_columns.append((grain, labels[codes[mask]]))
+            elif grain in TIME_GRAINS:
+                days = arrays["day"][mask].astype("datetime64[D]")
+                if grain == "day":
+                    buckets = days
+                elif grain == "week":
+                    # Weeks start on Monday; 1970-01-01 was a Thursday.
+                    buckets = (days - ((days.astype("int64") + 3) % 7).astype("timedelta64[D]"))
+                else:
+                    buckets = days.astype("datetime64[M]").astype("datetime64[D]")
+                group_columns.append((grain, np.datetime_as_string(buckets, unit="D").astype(object)))
+            else:
+                raise ValueError(f"Unknown group_by dimension: {grain}")
+
+        types = arrays["transaction_type"][0][arrays["transaction_type"][1][mask]]
+        statuses = arrays["transaction_status"][0][arrays["transaction_status"][1][mask]]
+        selected = pd.DataFrame({name: arrays[name][mask] for name in ("count", "amount_sum", "tax_sum")})
+        selected["refunds"] = selected["count"] * (types == "Refund")
+        selected["failed"] = selected["count"] * (statuses == "Failed")
+        selected["sales_amount"] = selected["amount_sum"] * ((types == "Sale") & (statuses == "Completed"))
+        totals = selected.sum()
+
+        rows = []
+        if group_columns:
+            for name, column in group_columns:
+                selected[name] = column
+            names = [name for name, _ in group_columns]
+            # Grouping runs over cells (a few per dimension combination and day), not over transactions.
+            for key, sums in selected.groupby(names, sort=True).sum().iterrows():
+                key = key if isinstance(key, tuple) else (key,)
+                row = dict(zip(names, key))
+                row["value"] = _measure_value(measure, sums)
+                row["transactions"] = int(sums["count"])
+                rows.append(row)
+            if not any(grain in TIME_GRAINS for grain in group_by):
+                # Rankings read best first; time series stay in chronological order.
+                rows.sort(key=lambda r: -(r["value"] or 0))
+        result = {
+            "rows": rows,
+            "total": {"value": _measure_value(measure, totals), "transactions": int(totals["count"])},
+        }
+        with self._lock:
+            self._report_cache[cache_key] = result
+            while len(self._report_cache) > REPORT_CACHE_SIZE:
+                self._report_cache.popitem(last=False)
+        return result
+
+def _measure_value(measure, sums):
+    count = sums["count"]
+    if measure == "count":
+        return int(count)
+    if measure == "total_amount":
+        return round(float(sums["amount_sum"]), 3)
+    if measure == "total_sales":
+        return round(float(sums["sales_amount"]), 3)
+    if measure == "total_tax":
+        return round(float(sums["tax_sum"]), 3)
+    if measure == "average_amount":
+        return round(float(sums["amount_sum"] / count), 3) if count else None
+    if measure == "refund_rate":
+        return round(float(sums["refunds"] / count * 100), 2) if count else None
+    if measure == "failure_rate":
+        return round(float(sums["failed"] / count * 100), 2) if count else None
+    raise ValueError(f"Unknown measure: {measure}")
@@ -0,0 +1,582 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import urllib.parse
+from collections import OrderedDict
+
+import faiss
+import numpy as np
+import pandas as pd
+
+from advisor_metrics import stage_timer
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration (override through environment variables) ---
+# Same data directory rag_agent_logic reads transactions.db and the FAISS index from, so the CLI and the API agree.
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+PARTITION_DIR = os.environ.get("ADVISOR_PARTITION_DIR", os.path.join(DATA_DIR, "partitions"))
+# The newest HOT_MONTHS months stay as a SQLite table + FAISS index; older months are compacted.
+HOT_MONTHS = int(os.environ.get("ADVISOR_HOT_MONTHS", "3"))
+# Months older than this are deleted by apply_retention(); 0 keeps the full history.
+RETENTION_MONTHS = int(os.environ.get("ADVISOR_RETENTION_MONTHS", "0"))
+# How many decompressed cold partitions may be held in memory at once.
+COLD_CACHE_PARTITIONS = int(os.environ.get("ADVISOR_COLD_CACHE_PARTITIONS", "2"))
+TABLE_NAME = "transactions"
+MANIFEST_FILE = "manifest.json"
+GENERATION_FILE = "GENERATION"  # Replaced after every manifest change, so other processes know to reload
+HOT_DB_FILE = "transactions.db"
+HOT_INDEX_FILE = "index.faiss"
+HOT_IDS_FILE = "index.faiss.ids.npy"
+COLD_ROWS_FILE = "rows.csv.gz"
+COLD_VECTORS_FILE = "vectors.npz"
+HOT = "hot"
+COLD = "cold"
+
+def month_key(timestamp):
+    return pd.Timestamp(timestamp).strftime("%Y-%m")
+
+def month_start(key):
+    return pd.Timestamp(f"{key}-01")
+
+def _rows_for_sql(df):
+    rows = df.copy()
+    if "transaction_date" in rows.columns and pd.api.types.is_datetime64_any_dtype(rows["transaction_date"]):
+        rows["transaction_date"] = rows["transaction_date"].astype(str)  # Stored as text, like data_ingestion_p2
+    return rows
+
+def _atomic_write_json(path, content):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(content, f, indent=2)
+    os.replace(tmp_path, path)
+
+def _connect_readonly(db_path):
+    """Read-only connection: never creates a missing database file (e.g. a month compacted meanwhile)."""
+    return sqlite3.connect(f"file:{urllib.parse.quote(os.path.abspath(db_path))}?mode=ro", uri=True)
+
+def _committed(index, ids, rows):
+    """The first `rows` vectors and IDs: anything past the manifest's count was left by an interrupted append."""
+    if index.ntotal <= rows and len(ids) <= rows:
+        return index, ids
+    logger.warning("Dropping %d uncommitted vectors past the manifest's %d rows.", max(index.ntotal, len(ids)) - rows, rows)
+    committed = faiss.IndexFlatL2(index.d)
+    committed.add(index.reconstruct_n(0, min(rows, index.ntotal)))
+    return committed, ids[:rows]
+
+# Raised by reads that raced with another process compacting, thawing or dropping the partition.
+PARTITION_READ_ERRORS = (sqlite3.Error, pd.errors.DatabaseError, OSError, RuntimeError, KeyError)
+
+class PartitionedStore:
+    """Transactions and their embeddings, partitioned by calendar month.
+
+    Each month is a directory under root holding a manifest plus either
+      hot:  a SQLite table (indexed on transaction_id) and a FAISS index with its .ids.npy map, or
+      cold: the rows as a gzip CSV and the vectors/IDs as a compressed .npz (read-only).
+    Searches and lookups only touch the months overlapping the requested [start, end) range.
+    Hot indexes stay loaded; cold partitions are decompressed on demand into a small LRU cache,
+    so memory is bounded by hot_months + cold_cache_size partitions whatever the history length.
+
+    Several processes may share a root (API workers plus a `maintain` job): manifests are re-read
+    whenever the GENERATION file changes, and reads that race with a compaction retry once.
+    The lock only guards the in-memory maps; files are read and decompressed outside it.
+    """
+
+    def __init__(self, root=PARTITION_DIR, hot_months=HOT_MONTHS, retention_months=RETENTION_MONTHS, cold_cache_size=COLD_CACHE_PARTITIONS):
+        self.root = root
+        self.hot_months = hot_months
+        self.retention_months = retention_months
+        self.cold_cache_size = cold_cache_size
+        self._lock = threading.RLock()
+        self._hot_indexes = {}  # month -> (faiss index, transaction ID array)
+        self._cold_cache = OrderedDict()  # month -> (rows DataFrame, faiss index, transaction ID array)
+        # month -> manifest. Replaced as a whole, never mutated, so readers need no lock to use it.
+        self._manifests = {}
+        self._generation = None
+        os.makedirs(root, exist_ok=True)
+        self._refresh_manifests(force=True)
+
+    def _path(self, key, filename=""):
+        return os.path.join(self.root, key, filename)
+
+    def _generation_signature(self):
+        try:
+            stat = os.stat(os.path.join(self.root, GENERATION_FILE))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _read_manifests(self):
+        manifests = {}
+        for key in sorted(os.listdir(self.root)):
+            try:
+                with open(os.path.join(self.root, key, MANIFEST_FILE)) as f:
+                    manifests[key] = json.load(f)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        return manifests
+
+    def _refresh_manifests(self, force=False):
+        """Re-reads the manifests if another process changed them (one stat() when nothing did).
+
+        Cached indexes and rows of months whose manifest changed are dropped.
+        """
+        signature = self._generation_signature()
+        if not force and signature == self._generation:
+            return
+        manifests = self._read_manifests()
+        with self._lock:
+            for key in set(self._manifests) | set(manifests):
+                if self._manifests.get(key) != manifests.get(key):
+                    self._hot_indexes.pop(key, None)
+                    self._cold_cache.pop(key, None)
+            self._manifests = manifests
+            self._generation = signature
+
+    def _bump_generation(self):
+        _atomic_write_json(os.path.join(self.root, GENERATION_FILE), {"pid": os.getpid(), "manifests": len(self._manifests)})
+
+    def _save_manifest(self, key, manifest):
+        _atomic_write_json(self._path(key, MANIFEST_FILE), manifest)
+        with self._lock:
+            self._manifests = dict(self._manifests, **{key: manifest})
+        self._bump_generation()
+
+    def _retrying(self, read):
+        """Runs read(); if it raced with another process changing a partition, reloads the manifests and retries once."""
+        try:
+            return read()
+        except PARTITION_READ_ERRORS as e:
+            logger.info("Partition read failed (%s); reloading manifests and retrying.", e)
+            self._refresh_manifests(force=True)
+            return read()
+
+    def partitions(self):
+        self._refresh_manifests()
+        return sorted(self._manifests)
+
+    def partitions_for_range(self, start=None, end=None):
+        """Months overlapping [start, end); None leaves that side open."""
+        keys = []
+        for key in self.partitions():
+            first_day = month_start(key)
+            if end is not None and first_day >= pd.Timestamp(end):
+                continue
+            if start is not None and first_day + pd.DateOffset(months=1) <= pd.Timestamp(start):
+                continue
+            keys.append(key)
+        return keys
+
+    def row_count(self):
+        return sum(self.row_counts().values())
+
+    def row_counts(self):
+        """{month: rows} for every partition."""
+        self._refresh_manifests()
+        return {key: manifest["rows"] for key, manifest in self._manifests.items()}
+
+    def data_version(self):
+        """Changes whenever a partition gains rows, is compacted or thawed, or is dropped (by any process).
+
+        Cheap enough for every request: a stat() of the GENERATION file and no lock.
+        """
+        self._refresh_manifests()
+        return ";".join(f"{key}:{m['state']}:{m['rows']}" for key, m in sorted(self._manifests.items()))
+
+    # --- Writes ---
+
+    def append(self, df, embeddings):
+        """Adds transactions and their embeddings (row-aligned) to their month partitions.
+
+        Rows for a month that has already been compacted thaw it back to hot first.
+        Returns the months written to.
+        """
+        if df.empty:
+            return []
+        embeddings = np.asarray(embeddings, dtype="float32")
+        keys = pd.to_datetime(df["transaction_date"]).dt.strftime("%Y-%m").to_numpy()
+        written = []
+        for key in np.unique(keys):
+            mask = keys == key
+            self._append_partition(str(key), df[mask], embeddings[mask])
+            written.append(str(key))
+        return written
+
+    def _append_partition(self, key, rows, vectors):
+        """Writes rows, vectors and IDs, then the manifest, whose row count is the commit point.
+
+        The index and IDs go to temporary files that replace the old ones once complete. A crash
+        before the manifest is saved leaves rows or vectors past its count; they are cut off again
+        by the next append (SQLite) and whenever the index is loaded (see _hot_index).
+        """
+        with self._lock:
+            manifest = self._manifests.get(key)
+            if manifest is not None and manifest["state"] == COLD:
+                logger.info("Thawing cold partition %s to append %d late rows.", key, len(rows))
+                self._thaw(key)
+                manifest = self._manifests[key]
+            os.makedirs(self._path(key), exist_ok=True)
+
+            index, ids = self._hot_index(key) if manifest is not None else (faiss.IndexFlatL2(vectors.shape[1]), np.array([], dtype="S"))
+            index = faiss.clone_index(index)  # The loaded copy keeps serving searches until the swap below
+            index.add(vectors)
+            ids = np.concatenate([ids, rows["transaction_id"].to_numpy(dtype="S")])
+            tmp_suffix = f".{os.getpid()}.tmp"
+            faiss.write_index(index, self._path(key, HOT_INDEX_FILE + tmp_suffix))
+            with open(self._path(key, HOT_IDS_FILE + tmp_suffix), "wb") as f:
+                np.save(f, ids)
+
+            conn = sqlite3.connect(self._path(key, HOT_DB_FILE))
+            if manifest is not None:
+                conn.execute(f"DELETE FROM {TABLE_NAME} WHERE rowid > ?", (manifest["rows"],))  # Left by an interrupted append
+            _rows_for_sql(rows).to_sql(TABLE_NAME, conn, if_exists="append", index=False)
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_id ON {TABLE_NAME}(transaction_id)")
+            conn.commit()
+            conn.close()
+            os.replace(self._path(key, HOT_INDEX_FILE + tmp_suffix), self._path(key, HOT_INDEX_FILE))
+            os.replace(self._path(key, HOT_IDS_FILE + tmp_suffix), self._path(key, HOT_IDS_FILE))
+            self._hot_indexes[key] = (index, ids)
+
+            dates = pd.to_datetime(rows["transaction_date"])
+            previous = manifest or {"rows": 0, "min_date": None, "max_date": None}
+            self._save_manifest(key, {
+                "month": key,
+                "state": HOT,
+                "rows": previous["rows"] + len(rows),
+                "dimension": int(vectors.shape[1]),
+                "min_date": str(min(filter(None, [previous["min_date"], str(dates.min())]))),
+                "max_date": str(max(filter(None, [previous["max_date"], str(dates.max())]))),
+            })
+
+    # --- Reads ---
+
+    def _hot_index(self, key):
+        with self._lock:
+            loaded = self._hot_indexes.get(key)
+        if loaded is None:
+            # Read outside the lock; two threads may both load a month once, which is harmless.
+            loaded = _committed(faiss.read_index(self._path(key, HOT_INDEX_FILE)), np.load(self._path(key, HOT_IDS_FILE)),
+                                self._manifests[key]["rows"])
+            with self._lock:
+                loaded = self._hot_indexes.setdefault(key, loaded)
+        return loaded
+
+    def _cold_partition(self, key):
+        with self._lock:
+            loaded = self._cold_cache.get(key)
+            if loaded is not None:
+                self._cold_cache.move_to_end(key)
+                return loaded
+        rows = pd.read_csv(self._path(key, COLD_ROWS_FILE))
+        with np.load(self._path(key, COLD_VECTORS_FILE)) as archive:
+            vectors, ids = archive["vectors"].astype("float32"), archive["ids"]
+        index = faiss.IndexFlatL2(vectors.shape[1])
+        index.add(vectors)
+        loaded = (rows, index, ids)
+        with self._lock:
+            self._cold_cache[key] = loaded
+            while len(self._cold_cache) > self.cold_cache_size:
+                self._cold_cache.popitem(last=False)
+        return loaded
+
+    def _cold_ids(self, key):
+        """A cold month's transaction IDs, from the cache or from just the IDs member of its .npz."""
+        with self._lock:
+            loaded = self._cold_cache.get(key)
+        if loaded is not None:
+            return loaded[2]
+        with np.load(self._path(key, COLD_VECTORS_FILE)) as archive:
+            return archive["ids"]
+
+    def _searchable(self, key):
+        """(faiss index, ID array) for a month, whichever form it is stored in."""
+        if self._manifests[key]["state"] == HOT:
+            return self._hot_index(key)
+        _, index, ids = self._cold_partition(key)
+        return index, ids
+
+    def search_partitions(self, start=None, end=None):
+        """Months a search covers: those overlapping [start, end), or only the hot months without a range.
+
+        Cold history is searched when a query asks for its dates, so range-less searches never
+        decompress cold months (or push the ones a ranged query needs out of the cache).
+        """
+        keys = self.partitions_for_range(start, end)
+        if start is None and end is None:
+            manifests = self._manifests
+            keys = [key for key in keys if manifests[key]["state"] == HOT] or keys[-1:]
+        return keys
+
+    def search(self, query_vectors, k=5, start=None, end=None):
+        """Top-k nearest transactions per query across the months search_partitions(start, end) picks.
+
+        Routing is per month: rows from the edge months outside the range can still be returned,
+        so callers wanting exact bounds filter the fetched details by date.
+        Returns one list per query of {"transaction_id", "score", "faiss_idx", "partition"}.
+        """
+        queries = np.atleast_2d(np.asarray(query_vectors, dtype="float32"))
+        candidates = [[] for _ in range(len(queries))]
+        searchable = self._retrying(lambda: [(key, *self._searchable(key)) for key in self.search_partitions(start, end)])
+        with stage_timer("vector_search"):
+            for key, index, ids in searchable:
+                if index.ntotal == 0:
+                    continue
+                distances, positions = index.search(queries, min(k, index.ntotal))
+                for row, (distance_row, position_row) in enumerate(zip(distances, positions)):
+                    candidates[row].extend(
+                        (float(distance), int(position), key, ids[position].decode())
+                        for distance, position in zip(distance_row, position_row) if position >= 0)
+        results = []
+        for row_candidates in candidates:
+            row_candidates.sort(key=lambda candidate: candidate[0])
+            results.append([{"transaction_id": transaction_id, "score": 1 - distance, "faiss_idx": position, "partition": key}
+                            for distance, position, key, transaction_id in row_candidates[:k]])
+        return results
+
+    def get_transaction_details_by_ids(self, transaction_ids, start=None, end=None):
+        """Full rows for transaction IDs from the months overlapping [start, end). Returns (df, error).
+
+        Hot months are queried first (indexed SQL). Cold months are only decompressed when they
+        actually hold one of the IDs still missing, which their stored ID arrays tell cheaply.
+        """
+        if not transaction_ids:
+            return pd.DataFrame(), "No transaction IDs provided."
+        with stage_timer("sql_fetch"):
+            frames = self._retrying(lambda: self._details(list(transaction_ids), start, end))
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            return pd.DataFrame(), "No details found for the provided transaction IDs."
+        return pd.concat(frames, ignore_index=True), None
+
+    def _details(self, transaction_ids, start, end):
+        keys = self.partitions_for_range(start, end)
+        manifests = self._manifests
+        frames = []
+        for key in [key for key in keys if manifests[key]["state"] == HOT]:
+            conn = _connect_readonly(self._path(key, HOT_DB_FILE))
+            placeholders = ",".join(["?" for _ in transaction_ids])
+            frames.append(pd.read_sql_query(
+                f"SELECT * FROM {TABLE_NAME} WHERE transaction_id IN ({placeholders})", conn, params=transaction_ids))
+            conn.close()
+        found = set().union(*(frame["transaction_id"] for frame in frames))
+        missing = np.asarray([transaction_id for transaction_id in map(str, transaction_ids) if transaction_id not in found], dtype="S")
+        for key in reversed([key for key in keys if manifests[key]["state"] == COLD]):
+            if len(missing) == 0:
+                break
+            held = np.isin(missing, self._cold_ids(key))
+            if held.any():
+                rows = self._cold_partition(key)[0]
+                frames.append(rows[rows["transaction_id"].isin(missing[held].astype(str))])
+                missing = missing[~held]
+        return frames
+
+    def load_range(self, start=None, end=None):
+        """All rows with start <= transaction_date < end (e.g. for the anomaly workflows)."""
+        frames = self._retrying(lambda: self._rows_in_range(start, end))
+        if not frames:
+            return pd.DataFrame()
+        rows = pd.concat(frames, ignore_index=True)
+        rows["transaction_date"] = pd.to_datetime(rows["transaction_date"])
+        if start is not None:
+            rows = rows[rows["transaction_date"] >= pd.Timestamp(start)]
+        if end is not None:
+            rows = rows[rows["transaction_date"] < pd.Timestamp(end)]
+        return rows.reset_index(drop=True)
+
+    def _rows_in_range(self, start, end):
+        keys = self.partitions_for_range(start, end)
+        manifests = self._manifests
+        frames = []
+        for key in keys:
+            if manifests[key]["state"] == HOT:
+                conn = _connect_readonly(self._path(key, HOT_DB_FILE))
+                frames.append(pd.read_sql_query(f"SELECT * FROM {TABLE_NAME}", conn))
+                conn.close()
+            else:
+                frames.append(self._cold_partition(key)[0])
+        return frames
+
+    def load_appended(self, seen=None):
+        """Rows added since a previous call, for incremental readers (the cube, the analytics snapshot).
+
+        seen is the {month: rows} position that call returned. Only months whose row count grew are
+        read, and from the month's first unread row on: partitions are append-only, so a hot month's
+        rowids run 1..rows and a compaction or thaw keeps that order. Months that shrank or were
+        dropped are not reported; callers notice them because the row counts no longer add up.
+        Returns (rows_df, position).
+        """
+        seen = seen or {}
+        self._refresh_manifests()
+        manifests = self._manifests
+        position = {key: manifest["rows"] for key, manifest in manifests.items()}  # From the same manifests as the reads
+        grown = [key for key, rows in position.items() if rows > seen.get(key, 0)]
+        frames = self._retrying(lambda: [self._rows_after(key, manifests[key], seen.get(key, 0)) for key in grown])
+        if not frames:
+            return pd.DataFrame(), position
+        return pd.concat(frames, ignore_index=True), position
+
+    def _rows_after(self, key, manifest, offset):
+        if manifest["state"] == HOT:
+            conn = _connect_readonly(self._path(key, HOT_DB_FILE))
+            rows = pd.read_sql_query(f"SELECT * FROM {TABLE_NAME} WHERE rowid > ? AND rowid <= ? ORDER BY rowid", conn,
+                                     params=(offset, manifest["rows"]))
+            conn.close()
+            return rows
+        return self._cold_partition(key)[0].iloc[offset:manifest["rows"]]
+
+    # --- Lifecycle: compaction and retention ---
+
+    def _cutoff_key(self, months, reference=None):
+        """Month key `months` months before the reference month (default: the newest partition)."""
+        partitions = self.partitions()
+        if not partitions:
+            return None
+        reference_month = month_start(month_key(reference) if reference is not None else partitions[-1])
+        return month_key(reference_month - pd.DateOffset(months=months - 1))
+
+    def compact(self, reference=None):
+        """Compacts hot partitions older than the newest hot_months months. Returns the months compacted."""
+        cutoff = self._cutoff_key(self.hot_months, reference)
+        compacted = []
+        with self._lock:
+            for key in self.partitions():
+                if cutoff is not None and key < cutoff and self._manifests[key]["state"] == HOT:
+                    self._compact_partition(key)
+                    compacted.append(key)
+        return compacted
+
+    def _compact_partition(self, key):
+        conn = _connect_readonly(self._path(key, HOT_DB_FILE))
+        # Committed rows only, kept in append order (see load_appended).
+        rows = pd.read_sql_query(f"SELECT * FROM {TABLE_NAME} WHERE rowid <= ? ORDER BY rowid", conn, params=(self._manifests[key]["rows"],))
+        conn.close()
+        index, ids = self._hot_index(key)
+        vectors = index.reconstruct_n(0, index.ntotal)
+
+        # Cold files are complete before the manifest flips, and hot files go only after it has.
+        rows.to_csv(self._path(key, COLD_ROWS_FILE + ".tmp"), index=False, compression="gzip")
+        os.replace(self._path(key, COLD_ROWS_FILE + ".tmp"), self._path(key, COLD_ROWS_FILE))
+        np.savez_compressed(self._path(key, "vectors.tmp.npz"), vectors=vectors, ids=ids)
+        os.replace(self._path(key, "vectors.tmp.npz"), self._path(key, COLD_VECTORS_FILE))
+        hot_bytes = sum(os.path.getsize(self._path(key, name)) for name in (HOT_DB_FILE, HOT_INDEX_FILE, HOT_IDS_FILE))
+        self._save_manifest(key, dict(self._manifests[key], state=COLD))
+        for name in (HOT_DB_FILE, HOT_INDEX_FILE, HOT_IDS_FILE):
+            os.remove(self._path(key, name))
+        self._hot_indexes.pop(key, None)
+        cold_bytes = sum(os.path.getsize(self._path(key, name)) for name in (COLD_ROWS_FILE, COLD_VECTORS_FILE))
+        logger.info("Compacted partition %s: %d rows, %.1f MB -> %.1f MB.", key, len(rows), hot_bytes / 1e6, cold_bytes / 1e6)
+
+    def _thaw(self, key):
+        rows, index, ids = self._cold_partition(key)
+        conn = sqlite3.connect(self._path(key, HOT_DB_FILE))
+        rows.to_sql(TABLE_NAME, conn, if_exists="replace", index=False)
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_id ON {TABLE_NAME}(transaction_id)")
+        conn.commit()
+        conn.close()
+        faiss.write_index(index, self._path(key, HOT_INDEX_FILE))
+        np.save(self._path(key, HOT_IDS_FILE), ids)
+        self._save_manifest(key, dict(self._manifests[key], state=HOT))
+        for name in (COLD_ROWS_FILE, COLD_VECTORS_FILE):
+            os.remove(self._path(key, name))
+        self._cold_cache.pop(key, None)
+        self._hot_indexes.pop(key, None)
+
+    def apply_retention(self, reference=None):
+        """Deletes partitions older than the newest retention_months months. Returns the months dropped."""
+        if self.retention_months <= 0:
+            return []
+        cutoff = self._cutoff_key(self.retention_months, reference)
+        dropped = []
+        with self._lock:
+            for key in self.partitions():
+                if key < cutoff:
+                    shutil.rmtree(self._path(key))
+                    self._manifests = {other: manifest for other, manifest in self._manifests.items() if other != key}
+                    self._hot_indexes.pop(key, None)
+                    self._cold_cache.pop(key, None)
+                    dropped.append(key)
+        if dropped:
+            self._bump_generation()
+            logger.info("Retention (%d months) dropped partitions: %s", self.retention_months, ", ".join(dropped))
+        return dropped
+
+    def maintain(self, reference=None):
+        """Runs compaction then retention; meant for a periodic job (cron, scheduler)."""
+        return {"compacted": self.compact(reference), "dropped": self.apply_retention(reference)}
+
+    def stats(self):
+        with self._lock:
+            partitions = []
+            for key, manifest in sorted(self._manifests.items()):
+                directory = self._path(key)
+                disk_bytes = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+                partitions.append({"month": key, "state": manifest["state"], "rows": manifest["rows"], "disk_bytes": disk_bytes})
+            return {
+                "partitions": partitions,
+                "hot_partitions_loaded": len(self._hot_indexes),
+                "cold_partitions_cached": len(self._cold_cache),
+            }
+
+def import_single_table(store, db_path, table_name, index_path, ids_path, chunk_rows=100_000):
+    """Splits the existing single transactions table + FAISS index (from data_ingestion_p2) into months.
+
+    Rows are read month by month (in table order within a month), so each month's partition is
+    written once and at most one month is held in memory.
+    """
+    index = faiss.read_index(index_path)
+    positions_by_id = pd.Index(np.load(ids_path).astype(str))
+    conn = sqlite3.connect(db_path)
+    imported = 0
+    pending, pending_vectors = [], []
+
+    def flush():
+        if pending:
+            store.append(pd.concat(pending, ignore_index=True), np.concatenate(pending_vectors))
+            pending.clear()
+            pending_vectors.clear()
+
+    query = f"SELECT * FROM {table_name} ORDER BY substr(transaction_date, 1, 7), rowid"
+    for chunk in pd.read_sql_query(query, conn, chunksize=chunk_rows):
+        positions = positions_by_id.get_indexer(chunk["transaction_id"].astype(str))
+        if (positions < 0).any():
+            logger.warning("Skipping %d rows without a vector in %s.", int((positions < 0).sum()), index_path)
+            chunk, positions = chunk[positions >= 0], positions[positions >= 0]
+        if not len(positions):
+            continue
+        vectors = index.reconstruct_batch(positions.astype("int64"))
+        keys = pd.to_datetime(chunk["transaction_date"]).dt.strftime("%Y-%m").to_numpy()
+        # Chunks arrive in month order: every month but the chunk's last is complete.
+        for key in pd.unique(keys):
+            mask = keys == key
+            if pending and month_key(pending[0]["transaction_date"].iloc[0]) != key:
+                flush()
+            pending.append(chunk[mask])
+            pending_vectors.append(vectors[mask])
+        imported += len(chunk)
+    flush()
+    conn.close()
+    return imported
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Month-partitioned transaction storage: import, compaction/retention and stats.")
+    parser.add_argument("command", choices=["import", "maintain", "stats"])
+    parser.add_argument("--root", default=PARTITION_DIR)
+    parser.add_argument("--db", default="transactions.db", help="Single-table database to import (import only)")
+    parser.add_argument("--index", default="transaction_index.faiss", help="FAISS index to import (import only)")
+    parser.add_argument("--hot-months", type=int, default=HOT_MONTHS)
+    parser.add_argument("--retention-months", type=int, default=RETENTION_MONTHS)
+    args = parser.parse_args()
+
+    partition_store = PartitionedStore(args.root, hot_months=args.hot_months, retention_months=args.retention_months)
+    if args.command == "import":
+        count = import_single_table(partition_store, args.db, TABLE_NAME, args.index, args.index + ".ids.npy")
+        print(f"Imported {count} transactions into {len(partition_store.partitions())} monthly partitions under {args.root}")
+    elif args.command == "maintain":
+        print(json.dumps(partition_store.maintain(), indent=2))
+    else:
+        print(json.dumps(partition_store.stats(), indent=2))
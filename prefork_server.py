@@ -0,0 +1,132 @@
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+
+import uvicorn
+
+# Importing the app pulls in advisor_logic, so the parent holds the same module objects the workers will use.
+from main_fastApi import app, load_all_models_once
+
+# --- Configuration ---
+DEFAULT_HOST = "0.0.0.0"
+DEFAULT_PORT = 8000
+DEFAULT_WORKERS = int(os.environ.get("ADVISOR_WORKERS", "2"))
+MEMORY_REPORT_DELAY_SECONDS = 5
+
+def process_memory_usage(pid="self"):
+    """Returns resident/shared/private memory (in MB) for a process, from /proc/<pid>/smaps_rollup.
+
+    Shared = pages also mapped by another process (copy-on-write pages inherited from the parent,
+    memory-mapped index files). Pss splits shared pages evenly across the processes mapping them.
+    """
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                    fields[parts[0][:-1]] = int(parts[1]) / 1024.0
+    except OSError:
+        return None
+    return {
+        "rss_mb": fields.get("Rss", 0.0),
+        "pss_mb": fields.get("Pss", 0.0),
+        "shared_mb": fields.get("Shared_Clean", 0.0) + fields.get("Shared_Dirty", 0.0),
+        "private_mb": fields.get("Private_Clean", 0.0) + fields.get("Private_Dirty", 0.0),
+    }
+
+def report_memory(worker_pids):
+    parent = process_memory_usage()
+    if parent is None:
+        print("Memory report unavailable (needs /proc/<pid>/smaps_rollup, i.e. Linux).")
+        return
+    print("--- Memory per process (MB) ---")
+    print(f"{'process':>16} {'rss':>9} {'shared':>9} {'private':>9} {'pss':>9}")
+    rows = [("parent", parent)] + [(f"worker {pid}", process_memory_usage(pid)) for pid in worker_pids]
+    for name, usage in rows:
+        if usage is not None:
+            print(f"{name:>16} {usage['rss_mb']:9.1f} {usage['shared_mb']:9.1f} {usage['private_mb']:9.1f} {usage['pss_mb']:9.1f}")
+
+def bind_socket(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+def run_worker(sock, log_level):
+    """Worker body: serve the already-initialised app on the inherited listening socket."""
+    # The startup event calls load_all_models_once() again, which returns at once because the
+    # parent already loaded everything; the model weights and index pages stay shared.
+    config = uvicorn.Config(app, log_level=log_level, lifespan="on")
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
+
+def spawn_worker(sock, log_level):
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            run_worker(sock, log_level)
+        finally:
+            os._exit(0)
+    return pid
+
+def serve(host, port, workers, log_level):
+    print(f"Pre-fork mode: loading models once in parent (pid {os.getpid()})...")
+    if not load_all_models_once():
+        print("CRITICAL: Models failed to load in the parent process. Aborting pre-fork start.")
+        return 1
+    # Move everything allocated so far into the permanent GC generation; otherwise the first
+    # collection in each worker writes to every object header and un-shares those pages.
+    gc.collect()
+    gc.freeze()
+
+    sock = bind_socket(host, port)
+    worker_pids = {spawn_worker(sock, log_level) for _ in range(workers)}
+    print(f"Started {len(worker_pids)} workers on http://{host}:{port}: {sorted(worker_pids)}")
+
+    stopping = False
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(worker_pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    time.sleep(MEMORY_REPORT_DELAY_SECONDS)
+    if not stopping:
+        report_memory(sorted(worker_pids))
+
+    while worker_pids:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        worker_pids.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} exited with status {status}; starting a replacement.")
+            worker_pids.add(spawn_worker(sock, log_level))
+    sock.close()
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve main_fastApi with N forked workers sharing one copy of the models and index.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+    sys.exit(serve(args.host, args.port, args.workers, args.log_level))
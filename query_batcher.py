@@ -0,0 +1,90 @@
+import asyncio
+import os
+from collections import Counter
+
+from advisor_metrics import QUERY_BATCH_SIZE, record_stage, start_request_timings
+
+# --- Configuration (override through environment variables) ---
+# A batch is flushed as soon as it holds MAX_BATCH_SIZE queries or MAX_WAIT_MS after its first query arrived.
+# Setting ADVISOR_BATCH_MAX_SIZE=1 effectively turns batching off.
+MAX_BATCH_SIZE = int(os.environ.get("ADVISOR_BATCH_MAX_SIZE", "32"))
+MAX_WAIT_MS = float(os.environ.get("ADVISOR_BATCH_MAX_WAIT_MS", "5"))
+
+class QueryBatcher:
+    """Coalesces concurrent semantic searches into one encode + one FAISS search.
+
+    search_batch_fn(query_texts, k, time_ranges) must return (list_of_result_lists, error) in query
+    order; time_ranges holds each query's (start, end), used to route partitioned searches.
+    It runs on `pool` (an api_concurrency.WorkPool), so the event loop only gathers and routes.
+    """
+
+    def __init__(self, search_batch_fn, pool, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.search_batch_fn = search_batch_fn
+        self.pool = pool
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self._pending = []
+        self._flush_handle = None
+        self._batch_tasks = set()  # The event loop only holds tasks weakly; keep running batches alive here
+        self.batch_size_counts = Counter()
+        self.total_queries = 0
+
+    async def search(self, query_text, k=5, start=None, end=None):
+        """Queues one query and waits for its results. Returns (results, error) like semantic_search."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((query_text, k, (start, end), future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait, self._flush)
+        results, error, batch_timings = await future
+        # The batch already fed the stage histograms once; here the shared stages are only
+        # copied into this caller's Server-Timing.
+        for stage, seconds in batch_timings:
+            record_stage(stage, seconds, observe=False)
+        return results, error
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        while self._pending:
+            batch = self._pending[:self.max_batch_size]
+            self._pending = self._pending[self.max_batch_size:]
+            task = asyncio.ensure_future(self._run_batch(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _run_batch(self, batch):
+        # One FAISS search serves every k in the batch; each caller gets its own top-k slice.
+        max_k = max(k for _, k, _, _ in batch)
+        query_texts = [query_text for query_text, _, _, _ in batch]
+        time_ranges = [time_range for _, _, time_range, _ in batch]
+        self.batch_size_counts[len(batch)] += 1
+        self.total_queries += len(batch)
+        QUERY_BATCH_SIZE.observe("query", len(batch))
+        # This task runs in its own context copy, so the batch's stage timings land here rather
+        # than in whichever request happened to trigger the flush.
+        batch_timings = start_request_timings()
+        try:
+            batch_results, error = await self.pool.submit(self.search_batch_fn, query_texts, max_k, time_ranges)
+        except Exception as e:
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, k, _, future), results in zip(batch, batch_results):
+            if not future.done():
+                future.set_result((results[:k], error, batch_timings))
+
+    def stats(self):
+        total_batches = sum(self.batch_size_counts.values())
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "batches": total_batches,
+            "queries": self.total_queries,
+            "mean_batch_size": (self.total_queries / total_batches) if total_batches else 0.0,
+            "batch_size_counts": {str(size): count for size, count in sorted(self.batch_size_counts.items())},
+        }
@@ -0,0 +1,154 @@
+import re
+
+import pandas as pd
+
+# --- Configuration ---
+LOOKUP = "lookup"
+AGGREGATE = "aggregate"
+
+# Phrases that ask for a number or a breakdown rather than for example transactions.
+AGGREGATE_CUES = re.compile(
+    r"\b(total|sum|revenue|how many|number of|count|average|avg|mean|rate|percentage|breakdown|"
+    r"report|summary|summarize|per (mall|branch|type|status|day|week|month)|"
+    r"by (mall|branch|type|status|day|week|month)|each (mall|branch|day|week|month)|"
+    r"daily|weekly|monthly)\b")
+
+MEASURE_PATTERNS = [
+    ("refund_rate", re.compile(r"\brefund(s)? rate\b|\brate of refunds?\b|\bpercentage of refunds?\b")),
+    ("failure_rate", re.compile(r"\b(failure|failed|fail|decline) rate\b|\brate of fail|\bpercentage of failed\b")),
+    ("average_amount", re.compile(r"\b(average|avg|mean)\b")),
+    ("total_tax", re.compile(r"\btax\b")),
+    ("count", re.compile(r"\b(how many|number of|count)\b")),
+    ("total_sales", re.compile(r"\b(sales|revenue|turnover)\b")),
+    ("total_amount", re.compile(r"\b(total|sum|amount)\b")),
+]
+
+GROUP_PATTERNS = [
+    ("branch_name", re.compile(r"\b(per|by|each|every|across) branch(es)?\b")),
+    ("mall_name", re.compile(r"\b(per|by|each|every|across) malls?\b")),
+    ("transaction_type", re.compile(r"\b(per|by|each) (transaction )?type\b")),
+    ("transaction_status", re.compile(r"\b(per|by|each) status\b")),
+    ("day", re.compile(r"\b(per|by|each) day\b|\bdaily\b")),
+    ("week", re.compile(r"\b(per|by|each) week\b|\bweekly\b")),
+    ("month", re.compile(r"\b(per|by|each) month\b|\bmonthly\b")),
+]
+
+STATUS_WORDS = {"Failed": re.compile(r"\bfail(ed|ures?)?\b"), "Completed": re.compile(r"\b(completed|successful)\b")}
+TYPE_WORDS = {"Refund": re.compile(r"\brefunds?\b"), "Sale": re.compile(r"\bsales?\b")}
+
+MONTHS = {name.lower(): number for number, name in enumerate(
+    ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"], start=1)}
+MONTH_PATTERN = re.compile(r"\b(in |during |for |of )?(" + "|".join(list(MONTHS) + [m[:3] for m in MONTHS]) + r")\b(?:\s+(\d{4}))?")
+LAST_N_PATTERN = re.compile(r"\b(?:last|past) (\d+) (day|week|month)s?\b")
+ISO_DATE_PATTERN = re.compile(r"\b(\d{4}-\d{2}-\d{2})\b")
+
+def classify_query(query_text):
+    """Returns AGGREGATE for questions answered by a number/breakdown, LOOKUP for similarity search."""
+    return AGGREGATE if AGGREGATE_CUES.search(query_text.lower()) else LOOKUP
+
+def _match_entities(text, names):
+    """Known names mentioned in text, longest first, without counting a name inside a longer match."""
+    found = []
+    for name in sorted(names, key=len, reverse=True):
+        if name.lower() in text and not any(name.lower() in longer.lower() for longer in found):
+            found.append(name)
+    return found
+
+def parse_time_range(text, reference_date):
+    """Turns relative/explicit dates in the question into a [start, end) pair of day-aligned Timestamps."""
+    today = pd.Timestamp(reference_date).normalize()
+    week_start = today - pd.Timedelta(days=today.weekday())
+    month_start = today.replace(day=1)
+    if "today" in text:
+        return today, today + pd.Timedelta(days=1)
+    if "yesterday" in text:
+        return today - pd.Timedelta(days=1), today
+    if "this week" in text:
+        return week_start, today + pd.Timedelta(days=1)
+    if "last week" in text:
+        return week_start - pd.Timedelta(days=7), week_start
+    if "this month" in text:
+        return month_start, today + pd.Timedelta(days=1)
+    if "last month" in text:
+        return month_start - pd.DateOffset(months=1), month_start
+    match = LAST_N_PATTERN.search(text)
+    if match:
+        amount, unit = int(match.group(1)), match.group(2)
+        offset = pd.DateOffset(months=amount) if unit == "month" else pd.Timedelta(days=amount * (7 if unit == "week" else 1))
+        return today + pd.Timedelta(days=1) - offset, today + pd.Timedelta(days=1)
+    match = ISO_DATE_PATTERN.search(text)
+    if match:
+        day = pd.Timestamp(match.group(1))
+        return day, day + pd.Timedelta(days=1)
+    for match in MONTH_PATTERN.finditer(text):
+        preposition, token, year = match.groups()
+        if token == "may" and not (preposition or year):
+            continue  # "may" the verb, not the month
+        month = MONTHS.get(token) or next(number for name, number in MONTHS.items() if name.startswith(token))
+        # Without a year, the most recent such month up to the reference date.
+        year = int(year) if year else (today.year if month <= today.month else today.year - 1)
+        start = pd.Timestamp(year=year, month=month, day=1)
+        return start, start + pd.DateOffset(months=1)
+    return None, None
+
+def extract_filters(text, malls, branches, measure=None):
+    """Mall/branch/status/type filters mentioned in (lower-cased) text, as {dimension: [values]}."""
+    filters = {}
+    matched_branches = _match_entities(text, branches)
+    if matched_branches:
+        filters["branch_name"] = matched_branches
+    matched_malls = [mall for mall in _match_entities(text, malls)
+                     if not any(branch.lower().startswith(mall.lower()) for branch in matched_branches)]
+    if matched_malls:
+        filters["mall_name"] = matched_malls
+    # Status/type words are filters unless they are what the measure is about ("refund rate", "sales").
+    if measure != "failure_rate":
+        statuses = [status for status, pattern in STATUS_WORDS.items() if pattern.search(text)]
+        if len(statuses) == 1:
+            filters["transaction_status"] = statuses
+    if measure not in ("refund_rate", "total_sales"):
+        types = [kind for kind, pattern in TYPE_WORDS.items() if pattern.search(text)]
+        if len(types) == 1:
+            filters["transaction_type"] = types
+    return filters
+
+def parse_aggregate_query(query_text, malls, branches, reference_date):
+    """Extracts measure, grouping, filters and time range for TransactionCube.report().
+
+    malls/branches are the values known to the cube; reference_date anchors "this week",
+    "yesterday" and similar phrases.
+    """
+    text = query_text.lower()
+    measure = next((name for name, pattern in MEASURE_PATTERNS if pattern.search(text)), "count")
+    group_by = [name for name, pattern in GROUP_PATTERNS if pattern.search(text)]
+    filters = extract_filters(text, malls, branches, measure)
+
+    if measure == "total_sales" and "transaction_status" in filters:
+        # "total failed sales": sum the amounts of those sales instead of completed-sales revenue.
+        measure = "total_amount"
+        filters["transaction_type"] = ["Sale"]
+
+    start, end = parse_time_range(text, reference_date)
+    return {
+        "measure": measure,
+        "group_by": group_by,
+        "filters": filters,
+        "start": start,
+        "end": end,
+    }
+
+def route_query(query_text, cube):
+    """Returns (LOOKUP, None) or (AGGREGATE, report_spec) for a natural-language question.
+
+    Relative dates are anchored at the newest transaction in the cube, so "this week" means the
+    latest week of data rather than the wall-clock week.
+    """
+    if classify_query(query_text) == LOOKUP or cube is None or cube.max_date is None:
+        return LOOKUP, None
+    spec = parse_aggregate_query(
+        query_text,
+        malls=cube.dimension_values("mall_name"),
+        branches=cube.dimension_values("branch_name"),
+        reference_date=cube.max_date,
+    )
+    return AGGREGATE, spec
@@ -1,3 +1,4 @@
+import logging
 import sqlite3
 import pandas as pd
 import faiss
@@ -5,6 +6,13 @@ from sentence_transformers import SentenceTransformer
 import numpy as np
 import os
 
+from advisor_metrics import stage_timer
+from partitioned_store import PARTITION_DIR, PartitionedStore
+from query_router import extract_filters
+from structured_encoder import load_index_encoder
+
+logger = logging.getLogger(__name__)
+
 # --- Configuration for Web App ---
 # Adjust paths to be relative to the location of this script or an absolute path within the web app structure
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -12,111 +20,383 @@ DATA_DIR = os.path.join(os.path.dirname(BASE_DIR), "data") # Assuming data direc
 
 DB_PATH = os.path.join(DATA_DIR, "transactions.db")
 TRANSACTIONS_TABLE_NAME = "transactions"
+CHANGE_LOG_TABLE_NAME = "transaction_changes"  # Written by triggers from data_ingestion_p2.install_change_log
 FAISS_INDEX_PATH = os.path.join(DATA_DIR, "transaction_index.faiss")
 FAISS_META_PATH = FAISS_INDEX_PATH + ".meta.csv"
+# Fixed-width copy of the meta CSV's transaction IDs, memory-mapped so pre-forked workers share its pages.
+FAISS_IDS_PATH = FAISS_INDEX_PATH + ".ids.npy"
+# Records which encoder built the index (text embeddings or structured_encoder.py features).
+FAISS_ENCODER_PATH = FAISS_INDEX_PATH + ".encoder.json"
+# Memory-map the FAISS index read-only instead of copying it onto each process's heap.
+FAISS_MMAP = os.environ.get("ADVISOR_FAISS_MMAP", "1") == "1"
 EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+# Month-partitioned rows + vectors (see partitioned_store.py, which owns PARTITION_DIR) instead of the single table and index.
+USE_PARTITIONED_STORAGE = os.environ.get("ADVISOR_PARTITIONED_STORAGE", "0") == "1"
 # CLEANED_CSV_PATH = os.path.join(DATA_DIR, "cleaned_jordan_transactions.csv") # May not be needed if DB is primary source
 
 # --- Global Variables for Loaded Models/Data (to avoid reloading on every query) ---
 faiss_index = None
 sentence_model = None
 faiss_id_map = None
+index_encoder = None  # StructuredTransactionEncoder when the index holds structured vectors, else None
+filter_vocabularies = None  # (malls, branches) named in questions, for the structured index's filter lookup
+partition_store = None
 retrieval_components_loaded = False
 
 def load_retrieval_components():
     """Loads FAISS index, sentence model, and transaction ID mapping."""
-    global faiss_index, sentence_model, faiss_id_map, retrieval_components_loaded
+    global faiss_index, sentence_model, faiss_id_map, index_encoder, filter_vocabularies, partition_store, retrieval_components_loaded
     if retrieval_components_loaded:
-        print("Retrieval components already loaded.")
+        logger.debug("Retrieval components already loaded.")
         return True
+    if USE_PARTITIONED_STORAGE:
+        return load_partitioned_components()
 
-    print("--- Loading Retrieval Components ---")
-    print(f"Looking for DB at: {DB_PATH}")
-    print(f"Looking for FAISS index at: {FAISS_INDEX_PATH}")
-    print(f"Looking for FAISS meta at: {FAISS_META_PATH}")
+    logger.info("--- Loading Retrieval Components ---")
+    logger.info("Looking for DB at: %s", DB_PATH)
+    logger.info("Looking for FAISS index at: %s", FAISS_INDEX_PATH)
+    logger.info("Looking for FAISS meta at: %s", FAISS_META_PATH)
 
     if not os.path.exists(FAISS_INDEX_PATH):
-        print(f"ERROR: FAISS index not found at {FAISS_INDEX_PATH}")
+        logger.error("FAISS index not found at %s", FAISS_INDEX_PATH)
         return False
     if not os.path.exists(FAISS_META_PATH):
-        print(f"ERROR: FAISS metadata not found at {FAISS_META_PATH}")
+        logger.error("FAISS metadata not found at %s", FAISS_META_PATH)
         return False
     if not os.path.exists(DB_PATH):
-        print(f"ERROR: Database not found at {DB_PATH}")
+        logger.error("Database not found at %s", DB_PATH)
         return False
 
     try:
-        print(f"Loading FAISS index from {FAISS_INDEX_PATH}...")
-        faiss_index = faiss.read_index(FAISS_INDEX_PATH)
-        print(f"FAISS index loaded. Total vectors: {faiss_index.ntotal}")
+        logger.info("Loading FAISS index from %s...", FAISS_INDEX_PATH)
+        faiss_index = read_faiss_index(FAISS_INDEX_PATH, mmap=FAISS_MMAP)
+        logger.info("FAISS index loaded. Total vectors: %d", faiss_index.ntotal)
 
-        print(f"Loading Sentence Transformer model: {EMBEDDING_MODEL_NAME}...")
-        sentence_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
-        print("Sentence Transformer model loaded.")
+        index_encoder = load_index_encoder(FAISS_ENCODER_PATH)
+        if index_encoder is not None:
+            # Structured vectors are compared row to row; there is no text model to load, so questions
+            # are answered by the filters they name instead (see _filter_search).
+            logger.info("FAISS index holds structured vectors (%d dims); text search falls back to filters.", index_encoder.dimension)
+            filter_vocabularies = _load_filter_vocabularies()
+        else:
+            logger.info("Loading Sentence Transformer model: %s...", EMBEDDING_MODEL_NAME)
+            sentence_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+            logger.info("Sentence Transformer model loaded.")
+
+        logger.info("Loading FAISS metadata (transaction IDs) from %s...", FAISS_META_PATH)
+        faiss_id_map = load_faiss_id_map(FAISS_META_PATH, FAISS_IDS_PATH)
+        logger.info("FAISS metadata loaded. Shape: %s", faiss_id_map.shape)
+        retrieval_components_loaded = True
+        return True
+    except Exception as e:
+        logger.error("Error loading retrieval components: %s", e)
+        retrieval_components_loaded = False
+        return False
 
-        print(f"Loading FAISS metadata (transaction IDs) from {FAISS_META_PATH}...")
-        faiss_id_map_df = pd.read_csv(FAISS_META_PATH)
-        faiss_id_map = pd.Series(faiss_id_map_df["transaction_id"].values, index=faiss_id_map_df["faiss_index"].values)
-        print(f"FAISS metadata loaded. Shape: {faiss_id_map.shape}")
+def load_partitioned_components():
+    """Partitioned-storage variant of load_retrieval_components: the sentence model plus the monthly partitions."""
+    global sentence_model, partition_store, retrieval_components_loaded
+    logger.info("--- Loading Retrieval Components (partitioned storage at %s) ---", PARTITION_DIR)
+    if not os.path.isdir(PARTITION_DIR):
+        logger.error("Partition directory not found at %s", PARTITION_DIR)
+        return False
+    try:
+        partition_store = PartitionedStore(PARTITION_DIR)
+        logger.info("Partitions loaded: %s (%d rows)", ", ".join(partition_store.partitions()), partition_store.row_count())
+        logger.info("Loading Sentence Transformer model: %s...", EMBEDDING_MODEL_NAME)
+        sentence_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
         retrieval_components_loaded = True
         return True
     except Exception as e:
-        print(f"Error loading retrieval components: {e}")
+        logger.error("Error loading partitioned retrieval components: %s", e)
         retrieval_components_loaded = False
         return False
 
-def semantic_search(query_text, k=5):
-    """Performs semantic search using FAISS and returns relevant transaction IDs and scores."""
+def get_data_version():
+    """Returns a cheap fingerprint of the DB and FAISS files; it changes whenever either is rebuilt."""
+    if partition_store is not None:
+        return partition_store.data_version()
+    parts = []
+    for path in (DB_PATH, FAISS_INDEX_PATH):
+        try:
+            stat = os.stat(path)
+            parts.append(f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+        except OSError:
+            parts.append("missing")
+    return ".".join(parts)
+
+def read_faiss_index(index_path, mmap=True):
+    """Reads a FAISS index, memory-mapped read-only when the index type supports it."""
+    if mmap:
+        try:
+            return faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except Exception as e:
+            logger.warning("Could not memory-map %s (%s); loading it into memory instead.", index_path, e)
+    return faiss.read_index(index_path)
+
+def save_faiss_id_map(transaction_ids, ids_path):
+    """Writes transaction IDs (in FAISS order) as a fixed-width byte-string .npy file."""
+    np.save(ids_path, np.asarray(transaction_ids, dtype="S"))
+
+def load_faiss_id_map(meta_path, ids_path):
+    """Returns the FAISS-position -> transaction ID array, memory-mapped from ids_path.
+
+    Unlike a pandas Series of Python strings, a mapped byte-string array has no per-item
+    refcounts, so forked workers read it without copying pages. The .npy is (re)built from
+    the meta CSV when missing or older than it.
+    """
+    if not os.path.exists(ids_path) or os.path.getmtime(ids_path) < os.path.getmtime(meta_path):
+        faiss_id_map_df = pd.read_csv(meta_path).sort_values("faiss_index")
+        save_faiss_id_map(faiss_id_map_df["transaction_id"].values, ids_path)
+    return np.load(ids_path, mmap_mode="r")
+
+def _results_from_search_row(distances_row, indices_row):
+    """Maps one row of FAISS search output back to transaction IDs."""
+    results = []
+    for faiss_result_idx, distance in zip(indices_row, distances_row):
+        if faiss_result_idx >= 0 and faiss_result_idx < len(faiss_id_map):
+            transaction_id = faiss_id_map[faiss_result_idx].decode()
+            results.append({"transaction_id": transaction_id, "score": 1 - distance, "faiss_idx": faiss_result_idx})
+        else:
+            logger.warning("FAISS index %s out of bounds for faiss_id_map (len: %d)", faiss_result_idx, len(faiss_id_map))
+    return results
+
+def semantic_search(query_text, k=5, start=None, end=None):
+    """Performs semantic search using FAISS and returns relevant transaction IDs and scores.
+
+    start/end narrow the search under partitioned storage (to the months they overlap; without them
+    only the hot months are searched) and on a structured index, which answers by filters instead.
+    """
     global faiss_index, sentence_model, faiss_id_map, retrieval_components_loaded
     if not retrieval_components_loaded:
-        print("Retrieval components not loaded. Attempting to load now.")
+        logger.warning("Retrieval components not loaded. Attempting to load now.")
         if not load_retrieval_components():
             return [], "Failed to load retrieval components."
 
+    if sentence_model is None:
+        results, error = _filter_search_batch([query_text], k, [(start, end)])
+        return results[0], error
+
     try:
-        print(f"\nPerforming semantic search for query: '{query_text}' with k={k}")
-        query_embedding = sentence_model.encode([query_text])
-        distances, indices = faiss_index.search(np.array(query_embedding).astype("float32"), k)
-        
-        results = []
-        for i in range(len(indices[0])):
-            faiss_result_idx = indices[0][i]
-            distance = distances[0][i]
-            if faiss_result_idx >= 0 and faiss_result_idx < len(faiss_id_map):
-                transaction_id = faiss_id_map.iloc[faiss_result_idx]
-                results.append({"transaction_id": transaction_id, "score": 1 - distance, "faiss_idx": faiss_result_idx})
-            else:
-                print(f"Warning: FAISS index {faiss_result_idx} out of bounds for faiss_id_map (len: {len(faiss_id_map)})")
-        print(f"Semantic search results: {results}")
+        logger.debug("Performing semantic search for query: %r with k=%d", query_text, k)
+        with stage_timer("encode"):
+            query_embedding = sentence_model.encode([query_text])
+        if partition_store is not None:
+            return partition_store.search(query_embedding, k, start, end)[0], None
+        with stage_timer("vector_search"):
+            distances, indices = faiss_index.search(np.array(query_embedding).astype("float32"), k)
+        results = _results_from_search_row(distances[0], indices[0])
+        logger.debug("Semantic search results: %s", results)
         return results, None
     except Exception as e:
         error_message = f"Error during semantic search: {e}"
-        print(error_message)
+        logger.error("%s", error_message)
         return [], error_message
 
-def get_transaction_details_by_ids(transaction_ids):
-    """Retrieves full transaction details from SQLite for a list of transaction IDs."""
+def semantic_search_batch(query_texts, k=5, time_ranges=None):
+    """Encodes and searches several queries in one model call and one FAISS call.
+
+    time_ranges optionally gives each query's (start, end); under partitioned storage queries are
+    grouped by range so each group searches only its months. A text-embedding single index ignores
+    them; a structured index applies them in its filter lookup.
+    Returns a list of per-query result lists (same shape as semantic_search results) and an error.
+    """
+    global faiss_index, sentence_model, faiss_id_map, retrieval_components_loaded
+    if not retrieval_components_loaded:
+        logger.warning("Retrieval components not loaded. Attempting to load now.")
+        if not load_retrieval_components():
+            return [[] for _ in query_texts], "Failed to load retrieval components."
+    if not query_texts:
+        return [], None
+    if sentence_model is None:
+        return _filter_search_batch(query_texts, k, time_ranges)
+
+    try:
+        with stage_timer("encode"):
+            query_embeddings = sentence_model.encode(list(query_texts), batch_size=len(query_texts))
+        if partition_store is not None:
+            return _search_partitions_by_range(np.asarray(query_embeddings, dtype="float32"), k, time_ranges), None
+        with stage_timer("vector_search"):
+            distances, indices = faiss_index.search(np.asarray(query_embeddings, dtype="float32"), k)
+        return [_results_from_search_row(distances[i], indices[i]) for i in range(len(query_texts))], None
+    except Exception as e:
+        error_message = f"Error during batched semantic search: {e}"
+        logger.error("%s", error_message)
+        return [[] for _ in query_texts], error_message
+
+def _search_partitions_by_range(query_embeddings, k, time_ranges):
+    """One partition_store.search per distinct (start, end) among the queries, results back in query order."""
+    time_ranges = time_ranges or [(None, None)] * len(query_embeddings)
+    results = [None] * len(query_embeddings)
+    positions_by_range = {}
+    for position, time_range in enumerate(time_ranges):
+        positions_by_range.setdefault(tuple(time_range), []).append(position)
+    for (start, end), positions in positions_by_range.items():
+        for position, hits in zip(positions, partition_store.search(query_embeddings[positions], k, start, end)):
+            results[position] = hits
+    return results
+
+def _load_filter_vocabularies():
+    """Mall and branch names for extract_filters: the encoder's vocabularies, or SQL for hashed columns."""
+    vocabularies = []
+    for column in ("mall_name", "branch_name"):
+        values = index_encoder.vocabularies.get(column)
+        if values is None:
+            conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+            values = [row[0] for row in conn.execute(f"SELECT DISTINCT {column} FROM {TRANSACTIONS_TABLE_NAME} WHERE {column} IS NOT NULL")]
+            conn.close()
+        vocabularies.append(values)
+    return tuple(vocabularies)
+
+def _filter_search_batch(query_texts, k, time_ranges=None):
+    """Text-search stand-in for a structured index, which has no text model.
+
+    Each question is answered with the newest transactions matching the mall, branch, status and type
+    it names, within its (start, end) range; every hit scores 1.0. Same return shape as semantic_search_batch.
+    """
+    time_ranges = time_ranges or [(None, None)] * len(query_texts)
+    try:
+        conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+        results = []
+        with stage_timer("sql_fetch"):
+            for query_text, (start, end) in zip(query_texts, time_ranges):
+                clauses, params = [], []
+                for column, values in extract_filters(query_text.lower(), *filter_vocabularies).items():
+                    clauses.append(f"{column} IN ({','.join('?' for _ in values)})")
+                    params.extend(values)
+                if start is not None:
+                    clauses.append("transaction_date >= ?")
+                    params.append(str(start))
+                if end is not None:
+                    clauses.append("transaction_date < ?")
+                    params.append(str(end))
+                where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+                rows = conn.execute(
+                    f"SELECT transaction_id FROM {TRANSACTIONS_TABLE_NAME}{where} ORDER BY transaction_date DESC LIMIT ?", params + [k])
+                results.append([{"transaction_id": str(row[0]), "score": 1.0} for row in rows])
+        conn.close()
+        return results, None
+    except Exception as e:
+        error_message = f"Error during filter search: {e}"
+        logger.error("%s", error_message)
+        return [[] for _ in query_texts], error_message
+
+def get_index_encoder():
+    """The StructuredTransactionEncoder the FAISS index was built with, or None for a text-embedding index."""
+    return index_encoder
+
+def find_similar_transactions(transaction_id, k=5):
+    """Nearest neighbours of an indexed transaction (its own stored vector as the query), for either encoder.
+
+    Returns (results, error) like semantic_search; results is None when the ID is not in the index.
+    """
+    if not retrieval_components_loaded and not load_retrieval_components():
+        return [], "Failed to load retrieval components."
+    if partition_store is not None:
+        return [], "find_similar_transactions is not available with partitioned storage."
+    try:
+        positions = np.flatnonzero(faiss_id_map == str(transaction_id).encode())
+        if len(positions) == 0:
+            return None, f"Transaction {transaction_id} is not in the FAISS index."
+        with stage_timer("vector_search"):
+            query_vector = faiss_index.reconstruct(int(positions[0])).reshape(1, -1)
+            distances, indices = faiss_index.search(query_vector, k + 1)
+        results = [result for result in _results_from_search_row(distances[0], indices[0]) if result["transaction_id"] != str(transaction_id)]
+        return results[:k], None
+    except Exception as e:
+        error_message = f"Error finding similar transactions: {e}"
+        logger.error("%s", error_message)
+        return [], error_message
+
+def get_transaction_details_by_ids(transaction_ids, start=None, end=None):
+    """Retrieves full transaction details from SQLite for a list of transaction IDs.
+
+    start/end (the search's time range) limit which months partitioned storage looks in.
+    """
     if not transaction_ids:
         return pd.DataFrame(), "No transaction IDs provided."
     if not retrieval_components_loaded: # DB path check is part of this
         return pd.DataFrame(), "Retrieval components (including DB access) not ready."
+    if partition_store is not None:
+        try:
+            return partition_store.get_transaction_details_by_ids(transaction_ids, start, end)
+        except Exception as e:
+            error_message = f"Error getting transaction details from partitions: {e}"
+            logger.error("%s", error_message)
+            return pd.DataFrame(), error_message
 
     try:
-        conn = sqlite3.connect(DB_PATH)
-        placeholders = ",".join(["?" for _ in transaction_ids])
-        query_sql = f"SELECT * FROM {TRANSACTIONS_TABLE_NAME} WHERE transaction_id IN ({placeholders})"
-        df_details = pd.read_sql_query(query_sql, conn, params=transaction_ids)
-        conn.close()
+        with stage_timer("sql_fetch"):
+            conn = sqlite3.connect(DB_PATH)
+            placeholders = ",".join(["?" for _ in transaction_ids])
+            query_sql = f"SELECT * FROM {TRANSACTIONS_TABLE_NAME} WHERE transaction_id IN ({placeholders})"
+            df_details = pd.read_sql_query(query_sql, conn, params=transaction_ids)
+            conn.close()
         if df_details.empty:
             return pd.DataFrame(), "No details found for the provided transaction IDs."
         return df_details, None
     except Exception as e:
         error_message = f"Error getting transaction details from SQL: {e}"
-        print(error_message)
+        logger.error("%s", error_message)
         return pd.DataFrame(), error_message
 
+def get_table_change_id():
+    """Newest entry of the transactions table's change log (in-place UPDATEs/DELETEs and replacements).
+
+    Incremental readers compare it with the value they saw when they last read rows; appends do not
+    move it. Returns (change_id, error); change_id is None for databases built without the log.
+    """
+    if partition_store is not None:
+        return 0, None  # Partitions are append-only; compaction/thaw/retention show up in the row count
+    try:
+        conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+        try:
+            change_id = conn.execute(f"SELECT COALESCE(MAX(change_id), 0) FROM {CHANGE_LOG_TABLE_NAME}").fetchone()[0]
+        except sqlite3.OperationalError:
+            change_id = None  # No change log table
+        conn.close()
+        return change_id, None
+    except Exception as e:
+        error_message = f"Error reading the transactions change log: {e}"
+        logger.error("%s", error_message)
+        return None, error_message
+
+def load_transactions_since(last_rowid=0):
+    """Reads rows appended to the transactions table after last_rowid (for incremental aggregates).
+
+    Returns (new_rows_df, max_rowid, table_row_count, error). table_row_count lets callers spot a
+    replaced table (rowids restart), in which case they should reload from rowid 0.
+    With partitioned storage the position is a {month: rows read} dict instead of a rowid, so only
+    the months that gained rows are read (see PartitionedStore.load_appended).
+    """
+    if partition_store is not None:
+        try:
+            if last_rowid and not isinstance(last_rowid, dict):
+                # A single-table rowid cannot be resumed from: nothing is read, so callers whose row
+                # count no longer matches reload from 0.
+                position = partition_store.row_counts()
+                return pd.DataFrame(), position, sum(position.values()), None
+            new_rows, position = partition_store.load_appended(last_rowid or None)
+            return new_rows, position, sum(position.values()), None
+        except Exception as e:
+            error_message = f"Error loading transactions from partitions: {e}"
+            logger.error("%s", error_message)
+            return pd.DataFrame(), last_rowid, 0, error_message
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        max_rowid, table_row_count = conn.execute(f"SELECT COALESCE(MAX(rowid), 0), COUNT(*) FROM {TRANSACTIONS_TABLE_NAME}").fetchone()
+        new_rows = pd.read_sql_query(
+            f"SELECT * FROM {TRANSACTIONS_TABLE_NAME} WHERE rowid > ? AND rowid <= ?", conn, params=(last_rowid, max_rowid))
+        conn.close()
+        return new_rows, max_rowid, table_row_count, None
+    except Exception as e:
+        error_message = f"Error loading new transactions from SQL: {e}"
+        logger.error("%s", error_message)
+        return pd.DataFrame(), last_rowid, 0, error_message
+
 # Example usage (for direct script testing)
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     if load_retrieval_components():
         sample_query = "failed sales at Z Mall Al Bayader recently"
         semantic_results, error = semantic_search(sample_query, k=3)
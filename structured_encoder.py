@@ -0,0 +1,138 @@
+import json
+import zlib
+
+import numpy as np
+import pandas as pd
+
+# --- Configuration ---
+CATEGORICAL_COLUMNS = ("mall_name", "branch_name", "transaction_type", "transaction_status")
+MAX_ONE_HOT = 64    # Vocabularies larger than this are feature-hashed instead of one-hot encoded
+HASH_BUCKETS = 32
+# Per-group weights: a feature group's contribution to squared L2 distance scales with weight**2.
+DEFAULT_WEIGHTS = {
+    "mall_name": 1.0,
+    "branch_name": 1.0,
+    "transaction_type": 1.0,
+    "transaction_status": 1.0,
+    "amount": 1.0,
+    "tax": 0.5,
+    "time_of_day": 0.5,
+    "day_of_week": 0.5,
+}
+ENCODER_NAME = "structured"
+
+class StructuredTransactionEncoder:
+    """Maps transactions straight to compact numeric vectors, without text or a language model.
+
+    Layout (in order): one block per categorical column (one-hot over the fitted vocabulary plus an
+    "unseen" slot, or HASH_BUCKETS hashed buckets for large vocabularies), standardised log amount,
+    standardised log tax, sin/cos of the time of day and sin/cos of the day of the week.
+    Every step is a whole-column NumPy/pandas operation, so encoding runs at millions of rows per second.
+    """
+
+    def __init__(self, weights=None, max_one_hot=MAX_ONE_HOT, hash_buckets=HASH_BUCKETS):
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.max_one_hot = max_one_hot
+        self.hash_buckets = hash_buckets
+        self.vocabularies = {}  # column -> sorted list of values, or None when hashed
+        self.numeric_stats = {}  # "amount"/"tax" -> (mean, std) of log1p values
+
+    def fit(self, df):
+        for column in CATEGORICAL_COLUMNS:
+            values = sorted(df[column].dropna().astype(str).unique())
+            self.vocabularies[column] = values if len(values) <= self.max_one_hot else None
+        for name, column in (("amount", "transaction_amount"), ("tax", "tax_amount")):
+            logs = np.log1p(np.clip(pd.to_numeric(df[column]).to_numpy(dtype="float64"), 0, None))
+            self.numeric_stats[name] = (float(logs.mean()), float(logs.std()) or 1.0)
+        return self
+
+    def fit_transform(self, df):
+        return self.fit(df).transform(df)
+
+    def _categorical_width(self, column):
+        vocabulary = self.vocabularies[column]
+        return len(vocabulary) + 1 if vocabulary is not None else self.hash_buckets
+
+    @property
+    def dimension(self):
+        return sum(self._categorical_width(column) for column in CATEGORICAL_COLUMNS) + 2 + 2 + 2
+
+    def _categorical_slots(self, column, values):
+        """Slot index within the column's block for every row.
+
+        Values are factorized once (a hash pass); only the distinct values are looked up or hashed,
+        and the result is broadcast back to the rows.
+        """
+        codes, uniques = pd.factorize(values, use_na_sentinel=False)
+        vocabulary = self.vocabularies[column]
+        if vocabulary is not None:
+            positions = {value: slot for slot, value in enumerate(vocabulary)}
+            # Unseen values share the block's last slot.
+            unique_slots = [positions.get(str(value), len(vocabulary)) for value in uniques]
+        else:
+            unique_slots = [zlib.crc32(str(value).encode("utf-8")) % self.hash_buckets for value in uniques]
+        return np.array(unique_slots, dtype="int64")[codes]
+
+    def transform(self, df):
+        """Returns a float32 array of shape (len(df), dimension)."""
+        if not self.numeric_stats:
+            raise ValueError("StructuredTransactionEncoder must be fitted before transform().")
+        rows = len(df)
+        vectors = np.zeros((rows, self.dimension), dtype="float32")
+        row_index = np.arange(rows)
+        offset = 0
+        for column in CATEGORICAL_COLUMNS:
+            slots = self._categorical_slots(column, df[column])
+            vectors[row_index, offset + slots] = self.weights[column]
+            offset += self._categorical_width(column)
+
+        for name, column in (("amount", "transaction_amount"), ("tax", "tax_amount")):
+            mean, std = self.numeric_stats[name]
+            logs = np.log1p(np.clip(pd.to_numeric(df[column]).to_numpy(dtype="float64"), 0, None))
+            vectors[:, offset] = (logs - mean) / std * self.weights[name]
+            offset += 1
+
+        minutes = pd.to_datetime(df["transaction_date"]).to_numpy().astype("datetime64[m]").astype("int64")
+        minute_of_day = (minutes % 1440).astype("float64")
+        day_of_week = ((minutes // 1440 + 3) % 7).astype("float64")  # Monday = 0; 1970-01-01 was a Thursday
+        for name, angle in (("time_of_day", minute_of_day / 1440), ("day_of_week", day_of_week / 7)):
+            radians = 2 * np.pi * angle
+            vectors[:, offset] = np.sin(radians) * self.weights[name]
+            vectors[:, offset + 1] = np.cos(radians) * self.weights[name]
+            offset += 2
+        return vectors
+
+    def to_dict(self):
+        return {
+            "encoder": ENCODER_NAME,
+            "weights": self.weights,
+            "max_one_hot": self.max_one_hot,
+            "hash_buckets": self.hash_buckets,
+            "vocabularies": self.vocabularies,
+            "numeric_stats": self.numeric_stats,
+            "dimension": self.dimension,
+        }
+
+    @classmethod
+    def from_dict(cls, params):
+        encoder = cls(weights=params["weights"], max_one_hot=params["max_one_hot"], hash_buckets=params["hash_buckets"])
+        encoder.vocabularies = params["vocabularies"]
+        encoder.numeric_stats = {name: tuple(stats) for name, stats in params["numeric_stats"].items()}
+        return encoder
+
+def save_encoder_meta(path, meta):
+    """Writes the sidecar that records which encoder built a FAISS index (and its fitted parameters)."""
+    with open(path, "w") as f:
+        json.dump(meta, f, indent=2)
+
+def load_index_encoder(path):
+    """Returns the StructuredTransactionEncoder recorded next to an index, or None for text-embedding indexes.
+
+    Indexes built before the sidecar existed have no file and are text-embedding indexes.
+    """
+    try:
+        with open(path) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    return StructuredTransactionEncoder.from_dict(meta) if meta.get("encoder") == ENCODER_NAME else None
@@ -1,9 +1,15 @@
+import logging
+import numpy as np
 import pandas as pd
 import sqlite3
 
 DB_PATH = "transactions.db"
 TRANSACTIONS_TABLE_NAME = "transactions"
 CLEANED_CSV_PATH = "cleaned_jordan_transactions.csv"
+# Sidecar written by data_ingestion_p2.py next to the FAISS index; holds the fitted structured encoder.
+INDEX_ENCODER_PATH = "transaction_index.faiss.encoder.json"
+
+logger = logging.getLogger(__name__)
 
 def load_data_from_sql(db_path, table_name):
     """Loads transaction data from the SQLite database."""
@@ -16,29 +22,29 @@ def load_data_from_sql(db_path, table_name):
             df['transaction_date'] = pd.to_datetime(df['transaction_date'])
         if 'transaction_amount' in df.columns:
             df['transaction_amount'] = pd.to_numeric(df['transaction_amount'])
-        print(f"Successfully loaded data from SQL. Shape: {df.shape}")
+        logger.info("Successfully loaded data from SQL. Shape: %s", df.shape)
         return df
     except Exception as e:
-        print(f"Error loading data from SQL: {e}")
+        logger.error("Error loading data from SQL: %s", e)
         # Fallback to CSV if SQL fails, though ideally SQL should be the source
         try:
-            print(f"Falling back to loading from CSV: {CLEANED_CSV_PATH}")
+            logger.warning("Falling back to loading from CSV: %s", CLEANED_CSV_PATH)
             df = pd.read_csv(CLEANED_CSV_PATH)
             if 'transaction_date' in df.columns:
                  df['transaction_date'] = pd.to_datetime(df['transaction_date'])
             if 'transaction_amount' in df.columns:
                 df['transaction_amount'] = pd.to_numeric(df['transaction_amount'])
-            print(f"Successfully loaded data from CSV. Shape: {df.shape}")
+            logger.info("Successfully loaded data from CSV. Shape: %s", df.shape)
             return df
         except Exception as e_csv:
-            print(f"Error loading data from CSV as fallback: {e_csv}")
+            logger.error("Error loading data from CSV as fallback: %s", e_csv)
             return None
 
 def detect_failed_transaction_anomaly(df, mall_name, time_window_hours=24, failure_threshold_percentage=50):
     """Detects anomaly if failed transactions for a specific mall exceed a threshold in a time window."""
-    print(f"\n--- Anomaly Detection: High Failed Transactions for {mall_name} ---")
+    logger.info("--- Anomaly Detection: High Failed Transactions for %s ---", mall_name)
     if df is None or df.empty:
-        print("No data to analyze.")
+        logger.info("No data to analyze.")
         return False, "No data"
 
     # Filter for the specific mall and recent transactions
@@ -47,7 +53,7 @@ def detect_failed_transaction_anomaly(df, mall_name, time_window_hours=24, failu
     mall_df = df[(df['mall_name'] == mall_name) & (df['transaction_date'] >= recent_time_cutoff)]
 
     if mall_df.empty:
-        print(f"No recent transactions found for {mall_name} in the last {time_window_hours} hours.")
+        logger.info("No recent transactions found for %s in the last %s hours.", mall_name, time_window_hours)
         return False, f"No recent transactions for {mall_name}"
 
     total_transactions = len(mall_df)
@@ -58,23 +64,23 @@ def detect_failed_transaction_anomaly(df, mall_name, time_window_hours=24, failu
     else:
         failure_rate = (failed_transactions / total_transactions) * 100
 
-    print(f"Mall: {mall_name}, Time Window: {time_window_hours}hrs")
-    print(f"Total Transactions: {total_transactions}, Failed Transactions: {failed_transactions}")
-    print(f"Failure Rate: {failure_rate:.2f}%")
+    logger.debug("Mall: %s, Time Window: %shrs", mall_name, time_window_hours)
+    logger.debug("Total Transactions: %d, Failed Transactions: %d", total_transactions, failed_transactions)
+    logger.debug("Failure Rate: %.2f%%", failure_rate)
 
     if failure_rate >= failure_threshold_percentage:
         alert_message = f"ALERT: High failed transaction rate for {mall_name}! {failure_rate:.2f}% failed in the last {time_window_hours} hours ({failed_transactions}/{total_transactions})."
-        print(alert_message)
+        logger.warning("%s", alert_message)
         return True, alert_message
     else:
-        print(f"Failure rate for {mall_name} ({failure_rate:.2f}%) is below threshold ({failure_threshold_percentage}%).")
+        logger.info("Failure rate for %s (%.2f%%) is below threshold (%s%%).", mall_name, failure_rate, failure_threshold_percentage)
         return False, f"Normal failure rate for {mall_name}"
 
 def detect_unusual_transaction_patterns(df, amount_std_dev_multiplier=3):
     """Detects transactions with amounts significantly deviating from the mean."""
-    print(f"\n--- Anomaly Detection: Unusual Transaction Amounts (Std Dev Multiplier: {amount_std_dev_multiplier}) ---")
+    logger.info("--- Anomaly Detection: Unusual Transaction Amounts (Std Dev Multiplier: %s) ---", amount_std_dev_multiplier)
     if df is None or df.empty or 'transaction_amount' not in df.columns:
-        print("No data or transaction_amount column to analyze.")
+        logger.info("No data or transaction_amount column to analyze.")
         return pd.DataFrame()
 
     mean_amount = df['transaction_amount'].mean()
@@ -85,9 +91,9 @@ def detect_unusual_transaction_patterns(df, amount_std_dev_multiplier=3):
     # Amounts are positive, so lower bound effectively min(0, calculated_lower_bound) if needed, but usually not for positive values.
     lower_bound = max(0, lower_bound) # Ensure lower bound is not negative for amounts
 
-    print(f"Mean Transaction Amount: {mean_amount:.2f}")
-    print(f"Std Dev Transaction Amount: {std_amount:.2f}")
-    print(f"Anomaly Bounds for Amount: ({lower_bound:.2f}, {upper_bound:.2f})")
+    logger.debug("Mean Transaction Amount: %.2f", mean_amount)
+    logger.debug("Std Dev Transaction Amount: %.2f", std_amount)
+    logger.debug("Anomaly Bounds for Amount: (%.2f, %.2f)", lower_bound, upper_bound)
 
     anomalous_transactions = df[
         (df['transaction_amount'] > upper_bound) |
@@ -95,14 +101,220 @@ def detect_unusual_transaction_patterns(df, amount_std_dev_multiplier=3):
     ]
 
     if not anomalous_transactions.empty:
-        print(f"Found {len(anomalous_transactions)} transactions with unusual amounts:")
-        print(anomalous_transactions[['transaction_id', 'mall_name', 'branch_name', 'transaction_date', 'transaction_amount', 'transaction_status']])
+        logger.info("Found %d transactions with unusual amounts.", len(anomalous_transactions))
+        if logger.isEnabledFor(logging.DEBUG):
+            columns = ['transaction_id', 'mall_name', 'branch_name', 'transaction_date', 'transaction_amount', 'transaction_status']
+            logger.debug("%s", anomalous_transactions[[column for column in columns if column in anomalous_transactions.columns]])
     else:
-        print("No transactions with amounts significantly deviating from the mean found.")
+        logger.info("No transactions with amounts significantly deviating from the mean found.")
     
     return anomalous_transactions
 
+DUPLICATE_KEY_COLUMNS = ['mall_name', 'branch_name', 'transaction_type', 'transaction_amount']
+# Structured-feature weights for fuzzy duplicates: only place, type and amount decide closeness. Status
+# differs inside a retry storm, and time is handled by the sweep's tolerance window.
+FUZZY_DUPLICATE_WEIGHTS = {"transaction_status": 0.0, "tax": 0.0, "time_of_day": 0.0, "day_of_week": 0.0}
+
+def _summarize_clusters(members):
+    """One row per cluster_id of members (the clustered transactions), largest cluster first.
+
+    transaction_ids lists each cluster's transaction_id values, or its index labels when members has
+    no such column (analytics snapshot frames, whose index holds row positions).
+    """
+    summary_columns = ['cluster_id', 'pattern', 'size', 'failed_count', 'completed_count', 'mall_name', 'branch_name',
+                       'transaction_type', 'min_amount', 'max_amount', 'first_transaction_date', 'last_transaction_date',
+                       'span_minutes', 'transaction_ids']
+    if members.empty:
+        return pd.DataFrame(columns=summary_columns)
+    members = members.assign(
+        is_failed=(members['transaction_status'] == 'Failed').astype('int64'),
+        is_completed=(members['transaction_status'] == 'Completed').astype('int64'),
+    )
+    if 'transaction_id' not in members.columns:
+        members = members.assign(transaction_id=members.index)
+    clusters = members.groupby('cluster_id', sort=False, observed=True).agg(
+        size=('cluster_id', 'size'),
+        failed_count=('is_failed', 'sum'),
+        completed_count=('is_completed', 'sum'),
+        mall_name=('mall_name', 'first'),
+        branch_name=('branch_name', 'first'),
+        transaction_type=('transaction_type', 'first'),
+        min_amount=('transaction_amount', 'min'),
+        max_amount=('transaction_amount', 'max'),
+        first_transaction_date=('transaction_date', 'min'),
+        last_transaction_date=('transaction_date', 'max'),
+        transaction_ids=('transaction_id', list),
+    ).reset_index()
+    clusters['span_minutes'] = (clusters['last_transaction_date'] - clusters['first_transaction_date']).dt.total_seconds() / 60
+    # Two or more completed charges look like a double charge; failures followed by retries look like a retry storm.
+    clusters['pattern'] = np.where(clusters['completed_count'] >= 2, 'possible_double_charge',
+                                   np.where(clusters['failed_count'] >= 1, 'retry_storm', 'repeated_transaction'))
+    clusters = clusters.sort_values(['size', 'first_transaction_date'], ascending=[False, True], ignore_index=True)
+    clusters['cluster_id'] = np.arange(len(clusters))
+    return clusters[summary_columns]
+
+def detect_duplicate_transaction_clusters(df, time_tolerance_minutes=10, amount_tolerance=0.0, min_cluster_size=2, key_columns=DUPLICATE_KEY_COLUMNS):
+    """Finds clusters of near-identical transactions (retry storms, double charges).
+
+    Rows are bucketed by a hashed key (mall, branch, type and amount rounded to amount_tolerance,
+    or to the fils when it is 0), sorted by (key, time) and swept once: a row joins the previous
+    row's cluster when it has the same key and follows it by at most time_tolerance_minutes.
+    The sort is the only O(n log n) step; everything else is a vectorized O(n) pass.
+    Returns one row per cluster with at least min_cluster_size transactions, largest first.
+    """
+    if df.empty:
+        logger.info("No transactions to check for duplicate clusters.")
+        return _summarize_clusters(df.assign(cluster_id=pd.Series(dtype='int64')))
+
+    times = pd.to_datetime(df['transaction_date']).to_numpy().astype('datetime64[ns]').astype('int64')
+    key_frame = df[key_columns].copy()
+    if 'transaction_amount' in key_frame.columns:
+        step = amount_tolerance if amount_tolerance > 0 else 0.001
+        # Amounts that straddle a bucket boundary are not matched; use the embedding search for fuzzier matches.
+        key_frame['transaction_amount'] = np.rint(pd.to_numeric(key_frame['transaction_amount']).to_numpy() / step).astype('int64')
+    # observed=True: snapshot frames hold categoricals, and only combinations that occur matter.
+    key_codes = key_frame.groupby(key_columns, sort=False, dropna=False, observed=True).ngroup().to_numpy()
+
+    order = np.lexsort((times, key_codes))
+    sorted_keys, sorted_times = key_codes[order], times[order]
+    starts_cluster = np.ones(len(order), dtype=bool)
+    starts_cluster[1:] = ((sorted_keys[1:] != sorted_keys[:-1]) |
+                          (np.diff(sorted_times) > int(time_tolerance_minutes * 60 * 1e9)))
+    cluster_ids = np.cumsum(starts_cluster) - 1
+    in_cluster = np.bincount(cluster_ids)[cluster_ids] >= min_cluster_size
+
+    members = df.iloc[order[in_cluster]].assign(cluster_id=cluster_ids[in_cluster])
+    members['transaction_date'] = pd.to_datetime(members['transaction_date'])
+    clusters = _summarize_clusters(members)
+    if not clusters.empty:
+        logger.info("Found %d near-duplicate clusters (%d transactions) within %s minutes.",
+                    len(clusters), int(clusters['size'].sum()), time_tolerance_minutes)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s", clusters.drop(columns=['transaction_ids']).head(20))
+    else:
+        logger.info("No near-duplicate transaction clusters found.")
+    return clusters
+
+def _connected_components(node_count, firsts, seconds):
+    """Component label (the smallest member) of every node, given edges firsts[i] - seconds[i].
+
+    Vectorized label propagation: each pass pulls the smaller label across every edge at once, then
+    pointer-jumps labels to their own labels. Labels only ever shrink and always name a node of the same
+    component, so the fixed point (equal labels across every edge) is the components. Passes grow with
+    the log of the component diameter, each is O(nodes + edges) NumPy work; there is no per-pair Python loop.
+    """
+    labels = np.arange(node_count)
+    while True:
+        pulled = labels.copy()
+        np.minimum.at(pulled, firsts, labels[seconds])
+        np.minimum.at(pulled, seconds, labels[firsts])
+        pulled = pulled[pulled]
+        if np.array_equal(pulled, labels):
+            return labels
+        labels = pulled
+
+def detect_near_duplicate_embeddings(df, embeddings, radius=0.05, time_tolerance_minutes=10, min_cluster_size=2, window_size=4096):
+    """Fuzzy variant of detect_duplicate_transaction_clusters using FAISS range search.
+
+    embeddings[i] is the vector of df.iloc[i] (for the ingestion index, index.reconstruct_n(0, index.ntotal)
+    in the order of the .ids.npy map). Transactions are taken in time order, window_size at a time; each
+    window is range-searched (squared L2 <= radius) against itself plus the rows that follow within
+    time_tolerance_minutes, so the cost grows with n * window_size rather than n^2. Matched pairs are
+    merged into clusters by _connected_components. Requires faiss.
+    """
+    import faiss
+
+    if df.empty:
+        return _summarize_clusters(df.assign(cluster_id=pd.Series(dtype='int64')))
+    vectors = np.ascontiguousarray(embeddings, dtype='float32')
+    times = pd.to_datetime(df['transaction_date']).to_numpy().astype('datetime64[ns]').astype('int64')
+    tolerance = int(time_tolerance_minutes * 60 * 1e9)
+    order = np.argsort(times, kind='stable')
+    sorted_times = times[order]
+
+    pair_firsts, pair_seconds = [], []
+    for start in range(0, len(order), window_size):
+        core_end = min(start + window_size, len(order))
+        end = int(np.searchsorted(sorted_times, sorted_times[core_end - 1] + tolerance, side='right'))
+        index = faiss.IndexFlatL2(vectors.shape[1])
+        index.add(vectors[order[start:end]])
+        lims, _, neighbours = index.range_search(vectors[order[start:core_end]], radius)
+        queries = np.repeat(np.arange(core_end - start), np.diff(lims).astype('int64')) + start
+        neighbours = neighbours.astype('int64') + start
+        pairs = (neighbours > queries) & (sorted_times[neighbours] - sorted_times[queries] <= tolerance)
+        pair_firsts.append(queries[pairs])
+        pair_seconds.append(neighbours[pairs])
+
+    roots = _connected_components(len(order), np.concatenate(pair_firsts), np.concatenate(pair_seconds))
+    in_cluster = np.bincount(roots, minlength=len(order))[roots] >= min_cluster_size
+    members = df.iloc[order[in_cluster]].assign(cluster_id=roots[in_cluster])
+    members['transaction_date'] = pd.to_datetime(members['transaction_date'])
+    clusters = _summarize_clusters(members)
+    logger.info("Embedding range search found %d fuzzy duplicate clusters (radius %s, %s minutes).",
+                len(clusters), radius, time_tolerance_minutes)
+    return clusters
+
+def detect_fuzzy_duplicate_clusters(df, amount_tolerance_ratio=0.02, time_tolerance_minutes=10, min_cluster_size=2):
+    """Near-duplicate clusters whose amounts differ by up to about amount_tolerance_ratio (2.05 vs 2.09).
+
+    detect_near_duplicate_embeddings over StructuredTransactionEncoder vectors weighted with
+    FUZZY_DUPLICATE_WEIGHTS, so mall, branch and type must match and only the log amount may differ;
+    the radius is that tolerance in the encoder's standardised units. Requires faiss.
+    """
+    from structured_encoder import StructuredTransactionEncoder
+
+    if df.empty:
+        return _summarize_clusters(df.assign(cluster_id=pd.Series(dtype='int64')))
+    encoder = StructuredTransactionEncoder(weights=FUZZY_DUPLICATE_WEIGHTS).fit(df)
+    radius = float((np.log1p(amount_tolerance_ratio) / encoder.numeric_stats["amount"][1]) ** 2)
+    return detect_near_duplicate_embeddings(df, encoder.transform(df), radius=radius,
+                                            time_tolerance_minutes=time_tolerance_minutes, min_cluster_size=min_cluster_size)
+
+def detect_structural_outliers(df, k=10, score_quantile=0.99, encoder=None, exact_max_rows=200_000, encoder_path=INDEX_ENCODER_PATH):
+    """Scores every transaction by how far it sits from its k nearest neighbours in structured-feature space.
+
+    Rows are encoded with StructuredTransactionEncoder (mall, branch, type, status, log amount/tax,
+    time of day, day of week), so a row is unusual when no similar combination occurs, not just when
+    its amount is extreme. The score is the mean squared L2 distance to the k nearest other rows
+    (exact FAISS search up to exact_max_rows rows, HNSW above). Returns the rows scoring above
+    score_quantile, highest first, with an outlier_score column. Requires faiss.
+
+    Without an explicit encoder, the one a structured index was built with (encoder_path) is used, so
+    scores share its vocabularies and scaling; a fresh encoder is fitted on df only if there is none.
+    """
+    import faiss
+    from structured_encoder import StructuredTransactionEncoder, load_index_encoder
+
+    if len(df) <= k:
+        logger.info("Too few transactions (%d) to score structural outliers with k=%d.", len(df), k)
+        return df.iloc[0:0].assign(outlier_score=pd.Series(dtype='float64'))
+
+    if encoder is None:
+        encoder = load_index_encoder(encoder_path)
+    if encoder is None:
+        logger.info("No structured index encoder at %s; fitting one on %d transactions.", encoder_path, len(df))
+        encoder = StructuredTransactionEncoder().fit(df)
+    vectors = encoder.transform(df)
+    if len(vectors) <= exact_max_rows:
+        index = faiss.IndexFlatL2(vectors.shape[1])
+    else:
+        index = faiss.IndexHNSWFlat(vectors.shape[1], 32)
+    index.add(vectors)
+    distances, _ = index.search(vectors, k + 1)  # The nearest hit is the row itself
+    scores = distances[:, 1:].mean(axis=1)
+
+    threshold = np.quantile(scores, score_quantile)
+    outliers = df.assign(outlier_score=scores)[scores > threshold].sort_values('outlier_score', ascending=False)
+    logger.info("Found %d structural outliers (kNN score above the %.0fth percentile, %.3f).",
+                len(outliers), score_quantile * 100, threshold)
+    if logger.isEnabledFor(logging.DEBUG):
+        columns = ['transaction_id', 'mall_name', 'branch_name', 'transaction_date', 'transaction_amount', 'transaction_status', 'outlier_score']
+        logger.debug("%s", outliers[[column for column in columns if column in outliers.columns]].head(20))
+    return outliers
+
 if __name__ == "__main__":
+    # DEBUG also shows the per-step figures and the anomalous rows themselves
+    logging.basicConfig(level=logging.DEBUG, format="%(message)s")
     transaction_df = load_data_from_sql(DB_PATH, TRANSACTIONS_TABLE_NAME)
 
     if transaction_df is not None:
@@ -114,12 +326,21 @@ if __name__ == "__main__":
         # Example 2: Detect unusual transaction amounts across all data
         unusual_amounts_df = detect_unusual_transaction_patterns(transaction_df, amount_std_dev_multiplier=2.5)
 
+        # Example 3: Same mall/branch/type/amount repeated within 10 minutes (retry storms, double charges)
+        duplicate_clusters_df = detect_duplicate_transaction_clusters(transaction_df, time_tolerance_minutes=10)
+
+        # Example 4: Rare combinations of branch, type, status, amount and time (structured-feature kNN)
+        structural_outliers_df = detect_structural_outliers(transaction_df, k=10, score_quantile=0.99)
+
         # Simulate sending alerts (in a real system, this would integrate with notification services)
         if is_failed_anomaly:
             print(f"\nWORKFLOW_ALERT_SIMULATION (Failed Transactions): {failed_message}")
         
         if not unusual_amounts_df.empty:
             print(f"\nWORKFLOW_ALERT_SIMULATION (Unusual Amounts): Found {len(unusual_amounts_df)} transactions with unusual amounts. Details logged above.")
+
+        if not duplicate_clusters_df.empty:
+            print(f"\nWORKFLOW_ALERT_SIMULATION (Near-Duplicates): Found {len(duplicate_clusters_df)} clusters of near-identical transactions. Details logged above.")
     else:
         print("Could not load transaction data for anomaly detection.")
 